@@ -0,0 +1,328 @@
+import logging
+import numpy as np
+import pandas as pd
+from typing import Union
+from .config import CONFIG
+from .data_loader import Funnel
+from .processor import FunnelData, PartitionedFunnelData, StageEventTables, is_dask, stage_inputs, stage_labels
+from .sketches import (hll_sketch, hll_precision, hll_error, hll_estimate, is_hll, hash_session_ids, tdigest_sketch,
+                       tdigest_merge, is_tdigest)
+
+def _decode(result):
+    """Decode the categorical keys of a small aggregate to plain labels, sorted like a string groupby."""
+    index = result.index
+    levels = [index.get_level_values(i) for i in range(index.nlevels)]
+    levels = [level.astype(object) if isinstance(level.dtype, pd.CategoricalDtype) else level for level in levels]
+    decoded = result.copy()
+    decoded.index = pd.MultiIndex.from_arrays(levels, names=index.names) if index.nlevels > 1 else levels[0]
+    return decoded.sort_index()
+
+def _distinct_sessions(df: pd.DataFrame, keys: list):
+    """Distinct sessions per keys group: exact, or a HyperLogLog sketch when CONFIG['distinct_error'] is set."""
+    if CONFIG['distinct_error'] is None:
+        return df.groupby(keys, observed=True)['session_id'].nunique()
+    return hll_sketch(df, keys, hll_precision(CONFIG['distinct_error']))
+
+def _summed_sessions(table: pd.DataFrame, keys: list):
+    """The 'sessions' counts of a StageEventTables table per keys group, summed over Dask partitions.
+
+    One sparse product counts each group once, so an in-memory table needs no groupby.
+    """
+    if is_dask(table):
+        return table.groupby(keys, observed=True)['sessions'].sum()
+    return table.set_index(keys)['sessions']
+
+def _table_sessions(table: pd.DataFrame, keys: list):
+    """Distinct sessions per keys group of a StageEventTables table: its summed counts, or a HyperLogLog
+    sketch of its session rows when CONFIG['distinct_error'] is set."""
+    if CONFIG['distinct_error'] is None:
+        return _summed_sessions(table, keys).rename('session_id')
+    return hll_sketch(table, keys, hll_precision(CONFIG['distinct_error']))
+
+def _stage_metrics(df: pd.DataFrame, tables: StageEventTables):
+    """Per-stage time/duration means and standard deviations in one groupby."""
+    return df.groupby('stage', observed=True).agg(
+        time_mean=('time_to_stage', 'mean'),
+        time_std=('time_to_stage', 'std'),
+        duration_mean=('duration', 'mean'),
+        duration_std=('duration', 'std')
+    )
+
+def _digest(column: str):
+    def metric(df: pd.DataFrame, tables: StageEventTables):
+        """Per-stage t-digest of the column, built per partition and merged."""
+        return tdigest_sketch(df, ['stage'], column, CONFIG['quantile_compression'])
+    return metric
+
+def _stage_session_metrics(df: pd.DataFrame, tables: StageEventTables):
+    """Distinct sessions per stage."""
+    return _distinct_sessions(df, ['stage'])
+
+def _stage_error_metrics(df: pd.DataFrame, tables: StageEventTables):
+    """Distinct sessions with an error event per stage."""
+    return _distinct_sessions(df[df['has_error']], ['stage'])
+
+def _stage_error_type_metrics(df: pd.DataFrame, tables: StageEventTables):
+    """Distinct sessions per stage and type of the error events seen anywhere in the session."""
+    return _table_sessions(tables.error_types, ['stage', 'error_type'])
+
+def _segment_metrics(df: pd.DataFrame, tables: StageEventTables):
+    """Distinct sessions per stage, gender and age."""
+    return _distinct_sessions(df, ['stage', 'gender', 'age'])
+
+def _url_metrics(df: pd.DataFrame, tables: StageEventTables):
+    """Distinct sessions per first-hit URL (per funnel and URL when several funnels are evaluated)."""
+    return _distinct_sessions(df, ['funnel', 'url'] if 'funnel' in df.columns else ['url'])
+
+def _stage_event_metrics(df: pd.DataFrame, tables: StageEventTables):
+    """Distinct sessions per stage and event seen anywhere in the session."""
+    return _table_sessions(tables.events, ['stage', 'event'])
+
+def _event_pair_metrics(df: pd.DataFrame, tables: StageEventTables):
+    """Sessions per stage and pair of events seen together anywhere in the session, counted exactly."""
+    return _summed_sessions(tables.event_pairs, ['stage', 'event', 'co_event'])
+
+def _age_group(age):
+    """Bucket ages into CONFIG['age_labels'] groups, for pandas and Dask series alike."""
+    if is_dask(age):
+        meta = pd.Series(pd.Categorical([], categories=CONFIG['age_labels'], ordered=True), name=age.name)
+        return age.map_partitions(_age_group, meta=meta)
+    return pd.cut(age, bins=CONFIG['age_bins'], labels=CONFIG['age_labels'])
+
+def _gender_metrics(df: pd.DataFrame, tables: StageEventTables):
+    """Distinct sessions per stage and gender."""
+    return _distinct_sessions(df, ['stage', 'gender'])
+
+def _age_group_metrics(df: pd.DataFrame, tables: StageEventTables):
+    """Distinct sessions per stage and age group."""
+    return _distinct_sessions(df.assign(age_group=_age_group(df['age'])), ['stage', 'age_group'])
+
+# Dimensions of the funnel cube, in storage order
+CUBE_DIMENSIONS = ['stage', 'gender', 'age_group', 'country', 'day']
+
+def _cube_metrics(df: pd.DataFrame, tables: StageEventTables):
+    """Sessions, error sessions and time/duration sums per stage x gender x age group x country x day cell.
+
+    A session has one row per stage it reached and falls in exactly one cell of each stage, so row
+    counts are distinct-session counts and stay correct when a stage's cells are summed over the other
+    dimensions; summing across stages would count a session once per stage. Missing demographics keep
+    their own cells so rollups still add up to the stage totals.
+    """
+    cells = df.assign(
+        age_group=_age_group(df['age']),
+        error=df['has_error'].astype('int64'),
+        time_sq=df['time_to_stage'] ** 2,
+        duration_sq=df['duration'] ** 2
+    )
+    return cells.groupby(CUBE_DIMENSIONS, observed=True, dropna=False).agg(
+        sessions=('session_id', 'count'),
+        error_sessions=('error', 'sum'),
+        time_sum=('time_to_stage', 'sum'),
+        time_sumsq=('time_sq', 'sum'),
+        duration_sum=('duration', 'sum'),
+        duration_sumsq=('duration_sq', 'sum')
+    )
+
+# Every aggregate the analyzer and visualizer need, declared up front so they can be evaluated together
+METRICS = {
+    'stage': _stage_metrics,
+    'stage_sessions': _stage_session_metrics,
+    'stage_error_sessions': _stage_error_metrics,
+    'stage_error_types': _stage_error_type_metrics,
+    'segments': _segment_metrics,
+    'urls': _url_metrics,
+    'stage_events': _stage_event_metrics,
+    'event_pairs': _event_pair_metrics,
+    'gender': _gender_metrics,
+    'age_groups': _age_group_metrics,
+    'time_digest': _digest('time_to_stage'),
+    'duration_digest': _digest('duration'),
+    'cube': _cube_metrics
+}
+
+def _stage_state_metrics(df: pd.DataFrame, tables: StageEventTables):
+    """Per-stage count, sum and sum of squares of times and durations."""
+    return df.assign(time_sq=df['time_to_stage'] ** 2, duration_sq=df['duration'] ** 2).groupby('stage', observed=True).agg(
+        time_count=('time_to_stage', 'count'),
+        time_sum=('time_to_stage', 'sum'),
+        time_sumsq=('time_sq', 'sum'),
+        duration_count=('duration', 'count'),
+        duration_sum=('duration', 'sum'),
+        duration_sumsq=('duration_sq', 'sum')
+    )
+
+# Per-day state: everything is a count, a sum or a sketch, so the days of any period merge without their rows.
+# Exact distinct-session counts add up because every session belongs to exactly one day;
+# HyperLogLog sketches merge by register maximum and need no such guarantee (event pairs are never sketched).
+STATE_METRICS = {**METRICS, 'stage': _stage_state_metrics}
+
+# Quantiles reported per stage next to the mean and standard deviation
+QUANTILES = {'median': 0.5, 'p90': 0.9, 'p99': 0.99}
+
+def _quantile(values: np.ndarray, counts: np.ndarray, q: float) -> float:
+    """Quantile of a t-digest (centroid means and weights), interpolated between centroid midpoints.
+
+    Positions are offset so that a digest of single values gives exactly Series.quantile.
+    """
+    midpoints = np.cumsum(counts) - counts / 2
+    return float(np.interp((counts.sum() - 1) * q + 0.5, midpoints, values))
+
+def _distribution_arrays(distribution: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    distribution = distribution.sort_index()
+    return distribution.index.to_numpy(dtype=float), distribution.to_numpy()
+
+def _distribution_summary(distribution: pd.Series) -> pd.Series:
+    """Quartiles, Tukey whiskers (most extreme centroids within 1.5 IQR) and exact range of one stage's t-digest."""
+    values, counts = _distribution_arrays(distribution)
+    q1, median, q3 = (_quantile(values, counts, q) for q in (0.25, 0.5, 0.75))
+    iqr = q3 - q1
+    return pd.Series({
+        'q1': q1,
+        'med': median,
+        'q3': q3,
+        'whislo': values[values >= q1 - 1.5 * iqr].min(),
+        'whishi': values[values <= q3 + 1.5 * iqr].max(),
+        'min': values.min(),
+        'max': values.max()
+    })
+
+def _digest_quantiles(digest: pd.Series, prefix: str) -> pd.DataFrame:
+    """QUANTILES of each stage's t-digest, as <prefix>_median, <prefix>_p90, ... columns."""
+    return pd.DataFrame({
+        f'{prefix}_{name}': {stage: _quantile(*_distribution_arrays(centroids.droplevel(0)), q)
+                             for stage, centroids in digest.groupby(level=0)}
+        for name, q in QUANTILES.items()
+    })
+
+def _merged_moments(totals: pd.DataFrame, prefix: str) -> tuple[pd.Series, pd.Series]:
+    """Mean and sample standard deviation from merged count, sum and sum of squares."""
+    count, total, total_sq = (totals[f'{prefix}_{name}'] for name in ('count', 'sum', 'sumsq'))
+    mean = total / count
+    variance = ((total_sq - total * mean) / (count - 1)).clip(lower=0)
+    return mean, np.sqrt(variance.where(count > 1))
+
+def _estimated(result):
+    """Final value of an aggregate: the distinct-count estimate of a HyperLogLog sketch, anything else as is."""
+    return hll_estimate(result) if is_hll(result) else result
+
+def _with_session_counts(stats: pd.DataFrame, sessions: pd.Series, error_sessions: pd.Series) -> pd.DataFrame:
+    """Per-stage statistics with the distinct session and error session counts in front (0 for stages without any)."""
+    return pd.DataFrame({
+        'sessions': sessions.reindex(stats.index, fill_value=0),
+        'error_sessions': error_sessions.reindex(stats.index, fill_value=0)
+    }).join(stats)
+
+def _finished(results: dict) -> dict:
+    """Final aggregates from evaluated or merged metrics.
+
+    Sketched distinct counts are estimated, and the per-stage moments, session counts and t-digest
+    quantiles form the 'stage' frame; the time-to-stage digest also gives the box plot summary.
+    """
+    results = {name: _estimated(result) for name, result in results.items()}
+    moments = results.pop('stage')
+    time_digest = results.pop('time_digest')
+    duration_digest = results.pop('duration_digest')
+    stats = moments.join(_digest_quantiles(time_digest, 'time')).join(_digest_quantiles(duration_digest, 'duration'))
+    stats = stats[[f'{prefix}_{stat}' for prefix in ('time', 'duration') for stat in ('mean', *QUANTILES, 'std')]]
+    stage = _with_session_counts(stats.rename_axis('stage'), results.pop('stage_sessions'), results.pop('stage_error_sessions'))
+    time_distribution = pd.concat({stage: _distribution_summary(centroids.droplevel(0))
+                                   for stage, centroids in time_digest.groupby(level=0)}, names=['stage'])
+    return {'stage': stage, **results, 'time_distribution': time_distribution.rename('time_to_stage')}
+
+def merge_states(states: list) -> dict:
+    """Merge per-day STATE_METRICS results into the aggregates compute_aggregates would return for all days."""
+    merged = {}
+    for name in STATE_METRICS:
+        parts = [state[name] for state in states]
+        if len({part.name for part in parts if isinstance(part, pd.Series)}) > 1:
+            raise ValueError(f"Day states disagree on how '{name}' was counted (exact vs. sketched, or another "
+                             "CONFIG['distinct_error']); rebuild them with the current settings")
+        if is_tdigest(parts[0]):
+            merged[name] = tdigest_merge(pd.concat(parts), CONFIG['quantile_compression'])
+            continue
+        grouped = pd.concat(parts).groupby(level=list(range(parts[0].index.nlevels)), dropna=False)
+        merged[name] = grouped.max() if is_hll(parts[0]) else grouped.sum()
+
+    totals = merged['stage']
+    time_mean, time_std = _merged_moments(totals, 'time')
+    duration_mean, duration_std = _merged_moments(totals, 'duration')
+    merged['stage'] = pd.DataFrame({
+        'time_mean': time_mean,
+        'time_std': time_std,
+        'duration_mean': duration_mean,
+        'duration_std': duration_std
+    })
+    return {name: _decode(result) for name, result in _finished(merged).items()}
+
+def _with_session_hash(df, data: Union[FunnelData, PartitionedFunnelData]):
+    """df with the session_hash column HyperLogLog sketches are built from.
+
+    In memory session_id holds integer codes local to one run, so the hash is taken of the original
+    id strings; sketches of different days and of the pandas and Dask paths then share registers.
+    """
+    if is_dask(df):
+        return df.assign(session_hash=df['session_id'].map_partitions(hash_session_ids, meta=('session_hash', 'u8')))
+    hashes = hash_session_ids(data.session_ids.to_series()).to_numpy()
+    return df.assign(session_hash=hashes[df['session_id'].to_numpy()])
+
+def _evaluate(data: Union[FunnelData, PartitionedFunnelData], metrics: dict) -> dict:
+    """Evaluate all declared metrics over one shared stage frame and its stage event tables.
+
+    The hit/session join, the session x event incidence matrix and the error matching are built once.
+    On the Dask path the metrics form one graph evaluated by a single dask.compute, so each partition
+    is read and processed only once and only the small aggregates reach the driver.
+    """
+    logging.info(f"Computing {len(metrics)} fused aggregates")
+    if isinstance(data, PartitionedFunnelData):
+        df, tables = data.hits, data.tables
+    else:
+        df, tables = stage_inputs(data)
+    if CONFIG['distinct_error'] is not None:
+        precision = hll_precision(CONFIG['distinct_error'])
+        logging.info(f"Counting distinct sessions with HyperLogLog sketches of 2**{precision} registers "
+                     f"(relative standard error {hll_error(precision):.2%})")
+        df = _with_session_hash(df, data)
+        tables = tables._replace(events=_with_session_hash(tables.events, data),
+                                 error_types=_with_session_hash(tables.error_types, data))
+
+    results = {name: metric(df, tables) for name, metric in metrics.items()}
+    if any(is_dask(result) for result in results.values()):
+        import dask
+        results = dask.compute(results)[0]
+    return {name: _decode(result) for name, result in results.items()}
+
+def compute_state(data: Union[FunnelData, PartitionedFunnelData]) -> dict:
+    """STATE_METRICS results of one day's data, with sketches left mergeable, for save_day_state."""
+    return _evaluate(data, STATE_METRICS)
+
+def compute_aggregates(data: Union[FunnelData, PartitionedFunnelData]) -> dict:
+    """Every aggregate the analyzer and visualizer need, from one fused evaluation of METRICS."""
+    return _finished(_evaluate(data, METRICS))
+
+def _funnel_part(result, funnel: str, labels: dict):
+    """The rows of one decoded aggregate that belong to funnel, keyed by its own stage names."""
+    if 'funnel' in result.index.names:
+        result = result[result.index.get_level_values('funnel') == funnel].droplevel('funnel')
+    if 'stage' not in result.index.names:
+        return result
+    result = result[result.index.get_level_values('stage').isin(list(labels))].copy()
+    levels = [result.index.get_level_values(i) for i in range(result.index.nlevels)]
+    position = result.index.names.index('stage')
+    levels[position] = levels[position].map(labels)
+    result.index = pd.MultiIndex.from_arrays(levels, names=result.index.names) if len(levels) > 1 else levels[0]
+    return result.sort_index()
+
+def split_funnels(aggregates: dict, funnels: list[Funnel]) -> dict:
+    """Per-funnel aggregates, by funnel name, from the aggregates of evaluating several funnels at once.
+
+    Each stage-keyed aggregate keeps only the funnel's stage labels, renamed back to its stage names,
+    so a funnel's aggregates are the ones evaluating it alone would give.
+    """
+    if len(funnels) == 1:
+        return {funnels[0].name: aggregates}
+    labels = iter(stage_labels(funnels))
+    split = {}
+    for funnel in funnels:
+        funnel_labels = {next(labels): stage for stage in funnel.stages}
+        split[funnel.name] = {name: _funnel_part(result, funnel.name, funnel_labels) for name, result in aggregates.items()}
+    return split
@@ -1,16 +1,45 @@
+from pathlib import Path
 import pandas as pd
-import dask.dataframe as dd
 import logging
 import numpy as np
 from .config import OUTPUT_DIR, CONFIG
 
-def analyze_funnel(df: pd.DataFrame, stages: list) -> tuple[pd.Series, pd.Series, pd.Series]:
+# Rows kept per stage in the top-events, lift and co-occurrence tables
+TOP_K = 5
+# Events in fewer than this share of a stage's sessions are too rare for a meaningful lift
+MIN_LIFT_SHARE = 0.01
+
+def _stage_table(values: pd.Series, stages: list) -> pd.DataFrame:
+    """Stage x key table, 0 where a key was not seen, of values indexed by stage and one or more keys."""
+    keys = values.index.names[1:]
+    table = values.unstack(keys, fill_value=0).reindex(stages, fill_value=0)
+    if table.columns.empty:  # Unstacking nothing loses the key names
+        table.columns = pd.MultiIndex.from_arrays([[]] * len(keys), names=keys) if len(keys) > 1 else pd.Index([], name=keys[0])
+    return table
+
+def _top_k(table: pd.DataFrame, k: int = TOP_K) -> pd.DataFrame:
+    """The k largest positive values in every row of a stage x key table, largest first (ties by key order).
+
+    Each row is partitioned with argpartition rather than sorted, so the cost grows with the number of keys, not its log.
+    """
+    values = table.to_numpy(dtype=float)
+    k = min(k, values.shape[1])
+    candidates = np.argpartition(-values, k - 1, axis=1)[:, :k] if k else np.empty((len(values), 0), dtype=int)
+    order = np.lexsort((candidates, -np.take_along_axis(values, candidates, axis=1)))
+    columns = np.take_along_axis(candidates, order, axis=1).ravel()
+    rows = np.repeat(np.arange(len(values)), k)
+    keep = values[rows, columns] > 0
+    rows, columns = rows[keep], columns[keep]
+    top = pd.DataFrame({'stage': table.index[rows]})
+    for level in range(table.columns.nlevels):
+        top[table.columns.names[level]] = table.columns.get_level_values(level)[columns]
+    top['value'] = values[rows, columns]
+    return top
+
+def analyze_funnel(aggregates: dict, stages: list, output_dir: Path = OUTPUT_DIR) -> tuple[pd.Series, pd.Series, pd.Series]:
     """Analyze funnel metrics and create a summary report."""
     logging.info("Analyzing funnel metrics")
-    if isinstance(df, dd.DataFrame):
-        stage_counts = df.groupby('stage')['session_id'].nunique().compute().reindex(stages).fillna(0)
-    else:
-        stage_counts = df.groupby('stage')['session_id'].nunique().reindex(stages).fillna(0)
+    stage_counts = aggregates['stage']['sessions'].reindex(stages).fillna(0)
     
     total_sessions = stage_counts[stages[0]]
     conversion_rates = (stage_counts / total_sessions).fillna(0)
@@ -26,62 +55,94 @@ def analyze_funnel(df: pd.DataFrame, stages: list) -> tuple[pd.Series, pd.Series
     summary_df['Key Insight'] = summary_df['Stage'].apply(
         lambda x: f"Biggest drop-off: {drop_off_rates[x]:.0%}" if x == max_drop_idx else ""
     )
-    summary_df.to_csv(OUTPUT_DIR / "funnel_summary.csv", index=False)
+    summary_df.to_csv(output_dir / "funnel_summary.csv", index=False)
     
     return stage_counts, conversion_rates, drop_off_rates
 
-def segment_users(df: pd.DataFrame, stages: list) -> pd.DataFrame:
+def segment_users(aggregates: dict, stages: list, output_dir: Path = OUTPUT_DIR) -> pd.DataFrame:
     """Segment users by demographics."""
     logging.info("Segmenting users by demographics")
-    if isinstance(df, dd.DataFrame):
-        segmented = df.groupby(['stage', 'gender', 'age'])['session_id'].nunique().compute().reset_index()
-    else:
-        segmented = df.groupby(['stage', 'gender', 'age'])['session_id'].nunique().reset_index()
+    segmented = aggregates['segments'].reset_index()
     
     segmented.columns = ['Stage', 'Gender', 'Age', 'User Count']
-    segmented['Age Group'] = pd.cut(segmented['Age'], bins=[0, 18, 35, 50, 100], labels=['0-18', '19-35', '36-50', '51+'])
+    segmented['Age Group'] = pd.cut(segmented['Age'], bins=CONFIG['age_bins'], labels=CONFIG['age_labels'])
     # Ensure stage order
     segmented['Stage'] = pd.Categorical(segmented['Stage'], categories=stages, ordered=True)
     segmented = segmented.sort_values('Stage')
-    segmented.to_csv(OUTPUT_DIR / "user_segments.csv", index=False)
+    segmented.to_csv(output_dir / "user_segments.csv", index=False)
     return segmented
 
-def analyze_root_causes(df: pd.DataFrame, stages: list) -> tuple[pd.Series, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+def analyze_root_causes(aggregates: dict, stages: list, output_dir: Path = OUTPUT_DIR) -> tuple[pd.Series, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
     """Analyze root causes with dynamic errors, events, and URLs."""
     logging.info("Performing root cause analysis")
-    if isinstance(df, dd.DataFrame):
-        time_spent = df.groupby('stage')['time_to_stage'].mean().compute()
-        df['has_error'] = df['events'].apply(lambda x: any('error' in str(e).lower() for e in x), meta=('has_error', 'bool'))
-        error_sessions = df[df['has_error']].groupby('stage')['session_id'].nunique().compute()
-        top_events = df.explode('events').groupby(['stage', 'events'])['session_id'].nunique().compute().reset_index()
-        url_dropoffs = df.groupby('url')['session_id'].nunique().compute().sort_values(ascending=False)
-        stats = df.groupby('stage').agg({'time_to_stage': ['mean', 'median', 'std'], 'duration': ['mean', 'median', 'std']}).compute()
-    else:
-        time_spent = df.groupby('stage')['time_to_stage'].mean()
-        df['has_error'] = df['events'].apply(lambda x: any('error' in str(e).lower() for e in x))
-        error_sessions = df[df['has_error']].groupby('stage')['session_id'].nunique()
-        top_events = df.explode('events').groupby(['stage', 'events'])['session_id'].nunique().reset_index()
-        url_dropoffs = df.groupby('url')['session_id'].nunique().sort_values(ascending=False)
-        stats = df.groupby('stage').agg({'time_to_stage': ['mean', 'median', 'std'], 'duration': ['mean', 'median', 'std']})
+    stage_metrics = aggregates['stage']
+    time_spent = stage_metrics['time_mean']
+    # Stages without any error session are left out, as a filtered groupby would
+    error_sessions = stage_metrics['error_sessions'][stage_metrics['error_sessions'] > 0]
+    stage_events = aggregates['stage_events']
+    url_dropoffs = aggregates['urls'].sort_values(ascending=False)
+    stats = stage_metrics[['time_mean', 'time_median', 'time_p90', 'time_p99', 'time_std',
+                           'duration_mean', 'duration_median', 'duration_p90', 'duration_p99', 'duration_std']]
     
     # Ensure stage order in time_spent
     time_spent = time_spent.reindex(stages)
     time_spent_df = pd.DataFrame({'Stage': time_spent.index, 'Avg Time to Stage (s)': time_spent.values.round(2)})
-    time_spent_df.to_csv(OUTPUT_DIR / "time_spent_per_stage.csv", index=False)
+    time_spent_df.to_csv(output_dir / "time_spent_per_stage.csv", index=False)
     
     # Ensure stage order in error_sessions
     error_sessions = error_sessions.reindex(stages)
     error_df = pd.DataFrame({'Stage': error_sessions.index, 'Sessions with Errors': error_sessions.values})
     error_df = error_df.dropna(subset=['Stage'])  # Remove any NaN stages
-    error_df.to_csv(OUTPUT_DIR / "error_sessions_per_stage.csv", index=False)
-    
-    # Ensure stage order in top_events
-    top_events['Stage'] = pd.Categorical(top_events['stage'], categories=stages, ordered=True)
-    top_events = top_events.sort_values('Stage')
-    # Select only the columns we need after nlargest
-    top_events_df = top_events.groupby('stage').apply(lambda x: x.nlargest(5, 'session_id'))[['stage', 'events', 'session_id']].reset_index(drop=True)
+    error_df.to_csv(output_dir / "error_sessions_per_stage.csv", index=False)
+
+    # Break errors down by CONFIG['error_patterns'] type; a session with several types counts under each
+    error_types_df = aggregates['stage_error_types'].rename('Sessions with Errors').reset_index()
+    error_types_df['stage'] = pd.Categorical(error_types_df['stage'], categories=stages, ordered=True)
+    error_types_df = error_types_df.sort_values(['stage', 'Sessions with Errors'], ascending=[True, False])
+    error_types_df.columns = ['Stage', 'Error Type', 'Sessions with Errors']
+    error_types_df.to_csv(output_dir / "error_types_per_stage.csv", index=False)
+
+    # Stage x event session counts, in stage order
+    event_counts = _stage_table(stage_events, stages)
+    top_events_df = _top_k(event_counts)
     top_events_df.columns = ['Stage', 'Event', 'User Count']
-    top_events_df.to_csv(OUTPUT_DIR / "top_events_per_stage.csv", index=False)
+    top_events_df['User Count'] = top_events_df['User Count'].astype(stage_events.dtype)
+    top_events_df.to_csv(output_dir / "top_events_per_stage.csv", index=False)
+
+    # Lift of each event at a stage over the funnel entry: its share of the stage's sessions against
+    # its share of the first stage's sessions
+    stage_sessions = stage_metrics['sessions'].reindex(stages).to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shares = event_counts.to_numpy(dtype=float) / stage_sessions[:, None]
+        lift = shares / shares[0]
+    lift[~np.isfinite(lift) | (shares < MIN_LIFT_SHARE)] = 0
+    lift_df = _top_k(pd.DataFrame(lift, index=event_counts.index, columns=event_counts.columns).iloc[1:])
+    position = (event_counts.index.get_indexer(lift_df['stage']), event_counts.columns.get_indexer(lift_df['event']))
+    lift_df = pd.DataFrame({
+        'Stage': lift_df['stage'],
+        'Event': lift_df['event'],
+        'Sessions': event_counts.to_numpy()[position],
+        'Share of Stage (%)': (shares[position] * 100).round(1),
+        f'Lift vs {stages[0]}': lift_df['value'].round(2)
+    })
+    lift_df.to_csv(output_dir / "top_event_lift_per_stage.csv", index=False)
+
+    # Most frequent pairs of events in the same session per stage, with their lift over independence
+    pairs = aggregates['event_pairs']
+    pairs_df = _top_k(_stage_table(pairs, stages))
+    stage_position = event_counts.index.get_indexer(pairs_df['stage'])
+    event_sessions = event_counts.to_numpy(dtype=float)
+    expected = (event_sessions[stage_position, event_counts.columns.get_indexer(pairs_df['event'])]
+                * event_sessions[stage_position, event_counts.columns.get_indexer(pairs_df['co_event'])]
+                / stage_sessions[stage_position])
+    pairs_df = pd.DataFrame({
+        'Stage': pairs_df['stage'],
+        'Event': pairs_df['event'],
+        'Co-Event': pairs_df['co_event'],
+        'Sessions': pairs_df['value'].astype(pairs.dtype),
+        'Lift': (pairs_df['value'] / expected).round(2)
+    })
+    pairs_df.to_csv(output_dir / "top_event_pairs_per_stage.csv", index=False)
 
     # Create initial URL DataFrame
     url_df = pd.DataFrame({'URL': url_dropoffs.index, 'Drop-Off Sessions': url_dropoffs.values})
@@ -98,12 +159,13 @@ def analyze_root_causes(df: pd.DataFrame, stages: list) -> tuple[pd.Series, pd.D
     
     filtered_url_df = url_df[url_df['Drop-Off Sessions'] >= threshold]
     # Save the filtered DataFrame
-    filtered_url_df.to_csv(OUTPUT_DIR / "top_dropoff_urls.csv", index=False)
+    filtered_url_df.to_csv(output_dir / "top_dropoff_urls.csv", index=False)
     
     stats_df = stats.reset_index()
     stats_df['stage'] = pd.Categorical(stats_df['stage'], categories=stages, ordered=True)
     stats_df = stats_df.sort_values('stage')
-    stats_df.columns = ['Stage', 'Time Mean (s)', 'Time Median (s)', 'Time Std (s)', 'Duration Mean (s)', 'Duration Median (s)', 'Duration Std (s)']
-    stats_df.to_csv(OUTPUT_DIR / "stage_stats.csv", index=False)
+    stats_df.columns = ['Stage', 'Time Mean (s)', 'Time Median (s)', 'Time P90 (s)', 'Time P99 (s)', 'Time Std (s)',
+                        'Duration Mean (s)', 'Duration Median (s)', 'Duration P90 (s)', 'Duration P99 (s)', 'Duration Std (s)']
+    stats_df.to_csv(output_dir / "stage_stats.csv", index=False)
     
     return time_spent, error_df, top_events_df, stats_df
\ No newline at end of file
@@ -0,0 +1,166 @@
+import argparse
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+import dask
+import numpy as np
+import pandas as pd
+from .config import CONFIG, OUTPUT_DIR, PACKAGE_DIR
+from .main import load_and_process, write_funnel_outputs
+from .aggregates import compute_aggregates
+from .profiling import Profiler, Span, max_rss_mb
+from .load_and_clean_data import transform_clickstream, filter_sessions, save_sessions_to_ndjson
+from .synthetic import SyntheticSpec, write_clickstream_csv, write_funnel_events, write_sessions_ndjson
+
+# Dask thresholds that force each processing path regardless of input size
+PATH_THRESHOLDS = {'pandas': float('inf'), 'dask': 0}
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+# Startup is timed in fresh interpreters: pandas is the floor, the last two are only loaded on demand
+STARTUP_IMPORTS = ['pandas', 'funnel_analysis.main', 'dask.dataframe', 'funnel_analysis.charts']
+STARTUP_EVENTS = 10_000
+_COLD_RUN = ("from funnel_analysis.config import CONFIG; "
+             "CONFIG.update(sessions_file={sessions_file!r}, funnel_events_file={funnel_events_file!r}, cache_dir=None); "
+             "from funnel_analysis.main import main; main(charts={charts})")
+
+def run_analysis(profiler: Profiler, path: str, sessions_file: str, funnel_events_file: str, charts: bool):
+    """Run the instrumented analysis of main() on the processing path given by path."""
+    data, funnels = load_and_process(sessions_file, profiler, funnel_events_file, PATH_THRESHOLDS[path])
+    with profiler.span('compute_aggregates') as result:
+        aggregates = compute_aggregates(data)
+        result['rows'] = int(sum(len(aggregate) for aggregate in aggregates.values()))
+    write_funnel_outputs(aggregates, funnels, data, profiler=profiler, charts=charts)
+
+def _fresh_interpreter(profiler: Profiler, phase: str, code: str, repeats: int, work_dir: Path, count_rows: bool = False):
+    """Run code in repeats new interpreters and record the fastest, with that interpreter's own CPU time and max RSS.
+
+    With count_rows the last line code prints is recorded as rows.
+    """
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [str(PACKAGE_DIR.parent), os.environ.get('PYTHONPATH')]))}
+    best = None
+    for _ in range(repeats):
+        wall = time.perf_counter()
+        child = subprocess.Popen([sys.executable, '-c', code], cwd=work_dir, env=env, text=True,
+                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = child.stdout.read()
+        # wait4 reports the resource usage of exactly this child
+        _, status, usage = os.wait4(child.pid, 0)
+        wall = time.perf_counter() - wall
+        child.returncode = os.waitstatus_to_exitcode(status)
+        child.stdout.close()
+        if child.returncode:
+            raise subprocess.CalledProcessError(child.returncode, [sys.executable, '-c', code], output)
+        rows = int(output.split()[-1]) if count_rows else -1
+        span = Span(phase, wall, usage.ru_utime + usage.ru_stime, float('nan'), max_rss_mb(usage), rows)
+        if best is None or span.wall_s < best.wall_s:
+            best = span
+    profiler.record(best)
+
+def measure_startup(profiler: Profiler, work_dir: Path, spec: SyntheticSpec, repeats: int, charts: bool = True):
+    """Time cold imports and a cold small run (the cron case) in fresh interpreters, fastest of repeats.
+
+    Import spans count the modules loaded as their rows.
+    """
+    profiler.labels = {'events': 0, 'path': 'startup'}
+    for module in STARTUP_IMPORTS:
+        _fresh_interpreter(profiler, f'import:{module}', f"import sys, {module}; print(len(sys.modules))",
+                           repeats, work_dir, count_rows=True)
+    sessions_file = work_dir / 'startup_sessions.ndjson'
+    funnel_events_file = work_dir / 'funnel_events.json'
+    write_sessions_ndjson(spec._replace(events=STARTUP_EVENTS), str(sessions_file))
+    write_funnel_events(str(funnel_events_file))
+    profiler.labels = {'events': STARTUP_EVENTS, 'path': 'startup'}
+    for draw in ([False, True] if charts else [False]):
+        code = _COLD_RUN.format(sessions_file=str(sessions_file), funnel_events_file=str(funnel_events_file), charts=draw)
+        _fresh_interpreter(profiler, 'cold_run' if draw else 'cold_run:no_charts', code, repeats, work_dir)
+
+def run_benchmark(sizes: list, paths: list, work_dir: Path, spec: SyntheticSpec, trace_memory: bool = True,
+                  charts: bool = True, startup_repeats: int = 3) -> Profiler:
+    """Generate a clickstream of each size and time every pipeline phase on it, for each processing path.
+
+    Every span is labelled with its input size in events and its path ('csv' for the cleaning phases,
+    'startup' for the fresh-interpreter timings of measure_startup, skipped when startup_repeats is 0).
+    """
+    profiler = Profiler(trace_memory)
+    if startup_repeats:
+        measure_startup(profiler, work_dir, spec, startup_repeats, charts)
+    funnel_events_file = str(work_dir / 'funnel_events.json')
+    write_funnel_events(funnel_events_file)
+    for events in sizes:
+        csv_file = str(work_dir / f'data-{events}.csv')
+        sessions_file = str(work_dir / f'sessions-{events}.ndjson')
+        profiler.labels = {'events': events, 'path': 'csv'}
+        with profiler.span('generate_clickstream') as result:
+            result['rows'] = write_clickstream_csv(spec._replace(events=events), csv_file)
+        with profiler.span('transform_clickstream') as result:
+            sessions = transform_clickstream(csv_file)
+            result['rows'] = len(sessions)
+        with profiler.span('filter_sessions') as result:
+            sessions = filter_sessions(sessions)
+            result['rows'] = len(sessions)
+        with profiler.span('save_sessions_to_ndjson') as result:
+            save_sessions_to_ndjson(sessions, sessions_file)
+            result['rows'] = len(sessions)
+        del sessions
+        for path in paths:
+            profiler.labels = {'events': events, 'path': path}
+            run_analysis(profiler, path, sessions_file, funnel_events_file, charts)
+    return profiler
+
+def _metadata(spec: SyntheticSpec, args: argparse.Namespace) -> dict:
+    return {
+        'started': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'dask': dask.__version__,
+        'trace_memory': not args.no_trace_memory,
+        'render_workers': args.render_workers,
+        'sizes': args.events,
+        'paths': args.paths,
+        'spec': spec._asdict(),
+        'config': {key: CONFIG[key] for key in ('batch_size', 'partition_sessions', 'distinct_error', 'quantile_compression')}
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark every funnel pipeline phase on synthetic clickstreams")
+    parser.add_argument("--events", type=int, nargs='+', default=DEFAULT_SIZES, help="Clickstream sizes in events")
+    parser.add_argument("--paths", nargs='+', choices=sorted(PATH_THRESHOLDS), default=sorted(PATH_THRESHOLDS),
+                        help="Processing paths to run the analysis on")
+    parser.add_argument("--vocabulary", type=int, default=SyntheticSpec._field_defaults['vocabulary'])
+    parser.add_argument("--conversion", type=float, nargs=4, default=SyntheticSpec._field_defaults['conversion'])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--work-dir", help="Where inputs and chart outputs are written (default: a temporary directory)")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON results; a CSV is written next to it")
+    parser.add_argument("--no-trace-memory", action="store_true",
+                        help="Skip tracemalloc, which slows allocation-heavy phases, to get undisturbed timings")
+    parser.add_argument("--no-charts", action="store_true", help="Skip chart rendering")
+    parser.add_argument("--startup-repeats", type=int, default=3,
+                        help="Fresh interpreters per import and cold-run timing, the fastest is kept (0: skip)")
+    parser.add_argument("--render-workers", type=int, default=0,
+                        help="Chart rendering processes; the default 0 draws in-process so each chart's memory is traced")
+    args = parser.parse_args()
+
+    spec = SyntheticSpec(events=0, vocabulary=args.vocabulary, conversion=tuple(args.conversion), seed=args.seed)
+    metadata = _metadata(spec, args)
+    output = Path(args.output).resolve()
+    with tempfile.TemporaryDirectory(prefix='funnel_bench_') as tmp_dir:
+        work_dir = Path(args.work_dir or tmp_dir).resolve()
+        work_dir.mkdir(parents=True, exist_ok=True)
+        # The analyzer writes into OUTPUT_DIR relative to the working directory; keep it inside work_dir
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        OUTPUT_DIR.mkdir(exist_ok=True)
+        CONFIG['render_workers'] = args.render_workers
+        try:
+            profiler = run_benchmark(args.events, args.paths, work_dir, spec, not args.no_trace_memory,
+                                     not args.no_charts, args.startup_repeats)
+        finally:
+            os.chdir(cwd)
+        profiler.save(output, metadata)
@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from pathlib import Path
+import pandas as pd
+from .config import CONFIG, OUTPUT_DIR, PACKAGE_DIR
+
+# Input paths (hashed by content instead) and settings that only change how fast a run is, never what it writes
+_UNVERSIONED_KEYS = {'sessions_file', 'funnel_events_file', 'funnels_file', 'batch_size', 'partition_sessions', 'spill_dir',
+                     'render_workers', 'cache_dir', 'state_dir'}
+
+def _update_with(digest, obj):
+    """Feed a stable byte representation of obj (pandas objects, containers, scalars) into digest."""
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        digest.update(type(obj).__name__.encode())
+        digest.update(repr(obj.dtypes if isinstance(obj, pd.DataFrame) else obj.dtype).encode())
+        digest.update(repr(list(obj.index.names)).encode())
+        if isinstance(obj, pd.DataFrame):
+            digest.update(repr(list(obj.columns)).encode())
+        else:
+            digest.update(repr(obj.name).encode())
+        digest.update(pd.util.hash_pandas_object(obj, index=True).to_numpy().tobytes())
+    elif isinstance(obj, dict):
+        for key in sorted(obj, key=str):
+            digest.update(repr(key).encode())
+            _update_with(digest, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        digest.update(f"{type(obj).__name__}{len(obj)}".encode())
+        for item in obj:
+            _update_with(digest, item)
+    else:
+        digest.update(repr(obj).encode())
+
+def _hash_file(path: Path, digest):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+
+def code_version() -> str:
+    """Hash of the package sources and every output-affecting CONFIG value."""
+    digest = hashlib.sha256()
+    for source in sorted(PACKAGE_DIR.glob('*.py')):
+        digest.update(source.name.encode())
+        _hash_file(source, digest)
+    settings = {key: value for key, value in CONFIG.items() if key not in _UNVERSIONED_KEYS}
+    digest.update(json.dumps(settings, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+class ArtifactCache:
+    """Content-addressed store of output artifacts with a JSON manifest.
+
+    objects/ holds one file per content key. The manifest records the key each file in OUTPUT_DIR
+    was produced from, and the full artifact set of each run keyed by its input files and code version.
+    Artifacts are named by their POSIX path below OUTPUT_DIR, e.g. 'search/funnel_chart.png'.
+    """
+
+    def __init__(self, cache_dir: str, output_dir: Path = OUTPUT_DIR):
+        self.cache_dir = Path(cache_dir)
+        self.output_dir = Path(output_dir)
+        self.objects_dir = self.cache_dir / 'objects'
+        self.manifest_path = self.cache_dir / 'manifest.json'
+        self.version = code_version()
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        if self.manifest_path.exists():
+            with open(self.manifest_path, 'r') as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'artifacts': {}, 'runs': {}}
+        self._keyed = set()  # Files placed under an input key during this run
+
+    def key(self, *parts) -> str:
+        """Content key for an artifact built from the given inputs by the current code."""
+        digest = hashlib.sha256(self.version.encode())
+        _update_with(digest, parts)
+        return digest.hexdigest()
+
+    def run_key(self, input_paths: list, *options) -> str:
+        """Content key of a whole run: the bytes of every input file (or store directory), the code version
+        and any run options that change which outputs are written."""
+        digest = hashlib.sha256(self.version.encode())
+        _update_with(digest, options)
+        for input_path in map(Path, input_paths):
+            files = sorted(p for p in input_path.rglob('*') if p.is_file()) if input_path.is_dir() else [input_path]
+            for path in files:
+                digest.update(str(path.relative_to(input_path.parent)).encode())
+                _hash_file(path, digest)
+        return digest.hexdigest()
+
+    def _object(self, key: str) -> Path:
+        return self.objects_dir / key[:2] / key
+
+    def restore(self, filename: str, key: str) -> bool:
+        """Make OUTPUT_DIR/filename hold the artifact for key; False if it has never been produced."""
+        target = self.output_dir / filename
+        if not self._object(key).exists():
+            return False
+        if self.manifest['artifacts'].get(filename) != key or not target.exists():
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(self._object(key), target)
+        self.manifest['artifacts'][filename] = key
+        self._keyed.add(filename)
+        return True
+
+    def store(self, filename: str, key: str = None) -> str:
+        """Copy OUTPUT_DIR/filename into the cache under key (its content hash if omitted)."""
+        source = self.output_dir / filename
+        if key is None:
+            digest = hashlib.sha256()
+            _hash_file(source, digest)
+            key = digest.hexdigest()
+        if not self._object(key).exists():
+            self._object(key).parent.mkdir(exist_ok=True)
+            shutil.copyfile(source, self._object(key))
+        self.manifest['artifacts'][filename] = key
+        self._keyed.add(filename)
+        return key
+
+    def restore_run(self, run_key: str) -> bool:
+        """Restore every artifact of an earlier run with the same key; False if there was none."""
+        artifacts = self.manifest['runs'].get(run_key)
+        if artifacts is None or not all(self._object(key).exists() for key in artifacts.values()):
+            return False
+        for filename, key in artifacts.items():
+            self.restore(filename, key)
+        self.save()
+        return True
+
+    def store_run(self, run_key: str, started: float, subdirs: list = ()):
+        """Record every file written to OUTPUT_DIR (and to its given subdirs) since started as the artifact set of run_key."""
+        artifacts = {}
+        for directory in [self.output_dir] + [self.output_dir / subdir for subdir in subdirs]:
+            for path in sorted(directory.iterdir()):
+                filename = path.relative_to(self.output_dir).as_posix()
+                if filename in self._keyed:
+                    artifacts[filename] = self.manifest['artifacts'][filename]
+                elif path.is_file() and path.stat().st_mtime >= started:
+                    artifacts[filename] = self.store(filename)
+        self.manifest['runs'][run_key] = artifacts
+        self.save()
+
+    def save(self):
+        """Write the manifest atomically."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
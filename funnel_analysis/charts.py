@@ -0,0 +1,170 @@
+import atexit
+import logging
+import threading
+import pandas as pd
+import matplotlib.pyplot as plt
+import seaborn as sns
+import plotly.graph_objects as go
+import kaleido
+
+# The plotting stack is only imported here, when a chart is actually drawn; each render_* function
+# writes one PNG from the small inputs of its ChartJob
+
+# Seconds the first render through the kept-alive kaleido browser may take before it is written off
+KALEIDO_PROBE_TIMEOUT = 15
+
+_kaleido_probed = False
+
+def _start_kaleido_server():
+    """Start the kept-alive kaleido browser, and stop it again unless it renders a blank figure within KALEIDO_PROBE_TIMEOUT.
+
+    start_sync_server returns before the browser is up, and if it never comes up (e.g. Chrome is missing)
+    every later render waits on it forever, so the probe runs on a daemon thread that may be abandoned.
+    With the server stopped, figures are written with a one-off browser each.
+    """
+    kaleido.start_sync_server(silence_warnings=True)
+    atexit.register(kaleido.stop_sync_server, silence_warnings=True)
+    rendered = []
+
+    def render_blank():
+        try:
+            rendered.append(kaleido.calc_fig_sync(go.Figure()))
+        except Exception as e:
+            logging.warning(f"kaleido browser failed to render: {e}")
+
+    probe = threading.Thread(target=render_blank, daemon=True)
+    probe.start()
+    probe.join(KALEIDO_PROBE_TIMEOUT)
+    if not rendered:
+        logging.warning(f"kaleido browser did not render within {KALEIDO_PROBE_TIMEOUT}s; writing each figure with its own browser")
+        kaleido.stop_sync_server(silence_warnings=True)
+
+def _write_plotly_image(fig: go.Figure, path):
+    """Write a plotly figure through one kaleido browser kept alive for the life of this process.
+
+    If that browser does not come up, each figure is written with a one-off browser instead, which raises
+    the usual kaleido error when there is no browser to start.
+    """
+    global _kaleido_probed
+    if not _kaleido_probed:
+        _start_kaleido_server()
+        _kaleido_probed = True
+    fig.write_image(path)
+
+def render_funnel_chart(path, stages: list, stage_counts: pd.Series):
+    fig = go.Figure(go.Funnel(
+        y=stages, x=stage_counts, textposition="inside", 
+        textinfo="value+percent previous", marker={"color": "teal"}
+    ))
+    fig.update_layout(title="User Journey Through Funnel", title_x=0.5)
+    _write_plotly_image(fig, path)
+
+def render_sessions_per_stage(path, stages: list, stage_counts: pd.Series):
+    plt.figure(figsize=(12, 6))
+    sns.barplot(x=stages, y=stage_counts, palette="Blues_d", order=stages)
+    plt.title('How Many Users Reach Each Stage?')
+    plt.xlabel('Stage')
+    plt.ylabel('Number of Users')
+    for i, v in enumerate(stage_counts):
+        plt.text(i, v + max(stage_counts) * 0.01, str(int(v)), ha='center', va='bottom')
+    plt.xticks(rotation=45)
+    plt.tight_layout()
+    plt.savefig(path)
+    plt.close()
+
+def render_drop_off_rates(path, stages: list, drop_off_rates: pd.Series):
+    plt.figure(figsize=(12, 6))
+    sns.barplot(x=stages[1:], y=drop_off_rates[1:] * 100, palette="Reds_d", order=stages[1:])
+    plt.title('Where Are We Losing Users? (%)')
+    plt.xlabel('Stage Transition')
+    plt.ylabel('Drop-Off Rate (%)')
+    for i, v in enumerate(drop_off_rates[1:] * 100):
+        plt.text(i, v + 1, f"{v:.1f}%", ha='center', va='bottom')
+    plt.xticks(rotation=45)
+    plt.tight_layout()
+    plt.savefig(path)
+    plt.close()
+
+def render_cumulative_drop_off(path, stages: list, conversion_rates: pd.Series):
+    # Cumulative Drop-Off Line Plot
+    cumulative_drop = (1 - conversion_rates) * 100
+    plt.figure(figsize=(12, 6))
+    sns.lineplot(x=stages, y=cumulative_drop, marker='o', color='purple')
+    plt.title('Cumulative Drop-Off Across Stages (%)')
+    plt.xlabel('Stage')
+    plt.ylabel('Cumulative Drop-Off Rate (%)')
+    for i, v in enumerate(cumulative_drop):
+        plt.text(i, v + 1, f"{v:.1f}%", ha='center', va='bottom')
+    plt.xticks(rotation=45)
+    plt.tight_layout()
+    plt.savefig(path)
+    plt.close()
+
+def render_time_spent(path, stages: list, time_spent: pd.Series):
+    plt.figure(figsize=(10, 6))
+    sns.barplot(x=stages, y=time_spent.reindex(stages), palette="Greens_d", order=stages)
+    plt.title('Average Time Spent Before Reaching Each Stage (s)')
+    plt.xlabel('Stage')
+    plt.ylabel('Time (seconds)')
+    for i, v in enumerate(time_spent.reindex(stages)):
+        plt.text(i, v + 1, f"{v:.1f}", ha='center', va='bottom')
+    plt.xticks(rotation=45)
+    plt.tight_layout()
+    plt.savefig(path)
+    plt.close()
+
+def render_error_sessions(path, stages: list, error_df: pd.DataFrame):
+    plt.figure(figsize=(10, 6))
+    sns.barplot(x='Stage', y='Sessions with Errors', data=error_df, palette="Reds_d", order=stages)
+    plt.title('Error Impact by Stage')
+    plt.xlabel('Stage')
+    plt.ylabel('Users Affected by Errors')
+    for i, v in enumerate(error_df['Sessions with Errors']):
+        plt.text(i, v + 1, str(int(v)), ha='center', va='bottom')
+    plt.xticks(rotation=45)
+    plt.tight_layout()
+    plt.savefig(path)
+    plt.close()
+
+def render_top_events(path, stages: list, top_events_df: pd.DataFrame):
+    plt.figure(figsize=(14, 8))
+    sns.barplot(x='Stage', y='User Count', hue='Event', data=top_events_df, palette="viridis", order=stages)
+    plt.title('Top 5 Events per Stage')
+    plt.xlabel('Stage')
+    plt.ylabel('Number of Users')
+    plt.legend(title='Event', bbox_to_anchor=(1.05, 1), loc='upper left')
+    plt.xticks(rotation=45)
+    plt.tight_layout()
+    plt.savefig(path, bbox_inches='tight')
+    plt.close()
+
+def render_time_to_stage_boxplot(path, stages: list, box_summary: pd.DataFrame):
+    # Boxes come from per-stage quartile/whisker summaries; of the outliers only the extremes are kept and drawn
+    box_stats = [{
+        'label': stage, 'q1': row['q1'], 'med': row['med'], 'q3': row['q3'], 'whislo': row['whislo'], 'whishi': row['whishi'],
+        'fliers': [v for v in (row['min'], row['max']) if v < row['whislo'] or v > row['whishi']]
+    } for stage, row in box_summary.iterrows()]
+    line = {'color': 'dimgray'}
+    plt.figure(figsize=(12, 6))
+    boxes = plt.gca().bxp(box_stats, positions=[stages.index(stage) for stage in box_summary.index], widths=0.8,
+                          patch_artist=True, boxprops=line, whiskerprops=line, capprops=line, medianprops=line,
+                          flierprops={'markeredgecolor': 'dimgray'})
+    for box, color in zip(boxes['boxes'], sns.color_palette("Pastel1")):
+        box.set_facecolor(color)
+    plt.title('Time to Reach Each Stage (s) - Distribution')
+    plt.xlabel('Stage')
+    plt.ylabel('Time (seconds)')
+    plt.xticks(rotation=45)
+    plt.tight_layout()
+    plt.savefig(path)
+    plt.close()
+
+def render_heatmap(path, pivot: pd.DataFrame, title: str, xlabel: str):
+    plt.figure(figsize=(8, 6))
+    sns.heatmap(pivot, annot=True, fmt='.1f', cmap='YlOrRd', cbar_kws={'label': 'Percentage (%)'})
+    plt.title(title)
+    plt.xlabel(xlabel)
+    plt.ylabel('Stage')
+    plt.tight_layout()
+    plt.savefig(path)
+    plt.close()
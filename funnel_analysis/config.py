@@ -8,7 +8,20 @@ CONFIG = {
     'sessions_file': str(PACKAGE_DIR / 'sessions.json'),
     'funnel_events_file': str(PACKAGE_DIR / 'funnel_events.json'),
     'dask_threshold': 100000,
-    'stage_order': ['Browsing', 'Adding to Cart', 'Checkout', 'Purchase']
+    'batch_size': 10000,  # sessions per streamed batch in process_sessions
+    'partition_sessions': 50000,  # target sessions per Dask partition above dask_threshold
+    'spill_dir': None,  # where JSON input above dask_threshold is sharded to Parquet (None: system temp dir)
+    'stage_order': ['Browsing', 'Adding to Cart', 'Checkout', 'Purchase'],
+    'funnels_file': None,  # JSON of funnel name -> {stage: [events]}, evaluated together (None: one funnel of stage_order)
+    'render_workers': None,  # chart rendering processes (None: one per core, 0 or 1: render in-process)
+    'cache_dir': 'funnel_analysis_output/.cache',  # content-addressed artifact cache (None: always recompute)
+    'state_dir': 'funnel_analysis_state',  # per-day aggregate state for incremental (--delta) runs
+    'quantile_compression': 100,  # t-digest compression of time/duration quantiles (more centroids, smaller error)
+    'distinct_error': None,  # relative standard error of HyperLogLog distinct-session counts (None: exact nunique)
+    'error_patterns': {'error': 'error'},  # error type -> regex searched case-insensitively in event names
+    'event_pairs': True,  # count co-occurring event pairs per stage (the table grows with the distinct pairs seen)
+    'age_bins': [0, 18, 35, 50, 100],
+    'age_labels': ['0-18', '19-35', '36-50', '51+']
 }
 
 # Output directory (still relative to the working directory, but can be adjusted if needed)
@@ -0,0 +1,93 @@
+import argparse
+import logging
+from typing import NamedTuple
+import pandas as pd
+from .aggregates import CUBE_DIMENSIONS
+from .config import OUTPUT_DIR
+
+CUBE_FILE = OUTPUT_DIR / "funnel_cube.parquet"
+
+class FunnelCube(NamedTuple):
+    """Materialized funnel cube.
+
+    cells has one row per observed stage x gender x age_group x country x day combination (categorical
+    dimensions, a datetime day, missing demographics as NaN) with additive measures: sessions,
+    error_sessions, time_sum, time_sumsq, duration_sum and duration_sumsq. A session counts once in each stage
+    it reached, so a rollup is exact as long as it keeps stage; summed over stages it would count a session
+    once per stage.
+    """
+    cells: pd.DataFrame
+
+    @classmethod
+    def from_metrics(cls, metrics: pd.DataFrame) -> 'FunnelCube':
+        """Build the cube from the 'cube' aggregate (cell measures indexed by CUBE_DIMENSIONS)."""
+        cells = metrics.reset_index()
+        for dimension in CUBE_DIMENSIONS:
+            if dimension != 'day':
+                cells[dimension] = cells[dimension].astype('category')
+        return cls(cells)
+
+    def slice(self, **criteria) -> 'FunnelCube':
+        """Cube restricted to cells whose dimensions match: a scalar selects one value, a list any of several."""
+        mask = pd.Series(True, index=self.cells.index)
+        for dimension, value in criteria.items():
+            if dimension not in CUBE_DIMENSIONS:
+                raise ValueError(f"Unknown cube dimension {dimension!r}; expected one of {CUBE_DIMENSIONS}")
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            if dimension == 'day':
+                values = pd.to_datetime(list(values))
+            mask &= self.cells[dimension].isin(values)
+        return FunnelCube(self.cells[mask].reset_index(drop=True))
+
+    def rollup(self, *dimensions: str) -> pd.DataFrame:
+        """Measures per stage summed over every dimension not listed, with mean and std of time to stage and duration.
+
+        stage is always kept, listed or not: a session has a row in every stage it reached, so summing over
+        stages would count session-stage pairs rather than sessions.
+        """
+        unknown = set(dimensions) - set(CUBE_DIMENSIONS)
+        if unknown:
+            raise ValueError(f"Unknown cube dimensions {sorted(unknown)}; expected some of {CUBE_DIMENSIONS}")
+        dimensions = ['stage'] + [d for d in dict.fromkeys(dimensions) if d != 'stage']
+        measures = self.cells.drop(columns=CUBE_DIMENSIONS)
+        totals = measures.groupby([self.cells[d] for d in dimensions], observed=True, dropna=False).sum()
+        for prefix in ('time', 'duration'):
+            n = totals['sessions']
+            mean = totals[f'{prefix}_sum'] / n
+            variance = (totals[f'{prefix}_sumsq'] - n * mean ** 2) / (n - 1)
+            totals[f'{prefix}_mean'] = mean
+            totals[f'{prefix}_std'] = variance.clip(lower=0) ** 0.5
+        return totals.drop(columns=['time_sumsq', 'duration_sumsq'])
+
+def save_cube(cube: FunnelCube, path=CUBE_FILE):
+    """Write the cube cells to Parquet; the categorical dimensions are stored dictionary-encoded."""
+    cube.cells.to_parquet(path, index=False)
+    logging.info(f"Saved funnel cube with {len(cube.cells)} cells to {path}")
+
+def load_cube(path=CUBE_FILE) -> FunnelCube:
+    """Read a cube written by save_cube."""
+    return FunnelCube(pd.read_parquet(path))
+
+def _criterion(text: str) -> tuple[str, list]:
+    dimension, _, values = text.partition('=')
+    if not values:
+        raise argparse.ArgumentTypeError(f"expected DIMENSION=VALUE[,VALUE...], got {text!r}")
+    return dimension, values.split(',')
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Roll up and slice the funnel cube")
+    parser.add_argument("--cube", default=str(CUBE_FILE), help="Cube file written by the analysis")
+    parser.add_argument("--by", nargs='*', default=[], choices=CUBE_DIMENSIONS,
+                        help="Dimensions to keep besides stage, which is always kept; every other dimension is summed over")
+    parser.add_argument("--where", nargs='*', type=_criterion, default=[], metavar="DIMENSION=VALUE[,VALUE...]",
+                        help="Restrict to cells matching every criterion, e.g. country=TH,VN day=2025-03-02")
+    parser.add_argument("--csv", help="Write the result to this CSV instead of printing it")
+    args = parser.parse_args()
+
+    cube = load_cube(args.cube).slice(**dict(args.where))
+    result = cube.rollup(*args.by)
+    if args.csv:
+        result.to_csv(args.csv)
+    else:
+        with pd.option_context('display.max_rows', None, 'display.width', 200):
+            print(result)
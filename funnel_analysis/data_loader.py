@@ -1,16 +1,219 @@
+import gzip
+import io
 import json
+import re
 import logging
+import warnings
+from itertools import islice
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple, Optional, Union
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+try:
+    import orjson
+except ImportError:  # Optional: NDJSON lines are then parsed with the stdlib decoder
+    orjson = None
+try:
+    import zstandard
+except ImportError:  # Optional: only needed for zstd-compressed session files
+    zstandard = None
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def load_data(sessions_file: str, funnel_events_file: str) -> tuple[dict, list]:
-    """Load sessions and funnel events from JSON files."""
+READ_CHUNK_SIZE = 1 << 20  # 1 MiB per read when streaming a JSON array
+_SEPARATORS = re.compile(r'[\s,]*')
+_FUNNEL_NAME = re.compile(r'[\w-]+')
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Schemas of the Parquet session store written by load_and_clean_data.py --format parquet (and synthetic.py)
+STORE_SCHEMAS = {
+    'sessions': pa.schema([('session_idx', pa.int64()), ('session_id', pa.string()), ('upm_id', pa.string()),
+                           ('age', pa.float64()), ('gender', pa.string()), ('country', pa.string()),
+                           ('start_session', pa.int64()), ('end_session', pa.int64())]),
+    'events': pa.schema([('session_idx', pa.int64()), ('event_name', pa.string()), ('search_keyword', pa.string()),
+                         ('filters', pa.string()), ('page_url', pa.string()), ('product_name', pa.string()),
+                         ('total', pa.string()), ('product_inventory_status', pa.string()), ('timestamp', pa.int64())])
+}
+# Columns the funnel pipeline needs from each table of a Parquet session store
+STORE_SESSION_COLUMNS = ['session_idx', 'session_id', 'start_session', 'end_session', 'age', 'gender', 'country']
+STORE_EVENT_COLUMNS = ['session_idx', 'event_name', 'timestamp', 'page_url']
+
+class SessionStore(NamedTuple):
+    """Columnar sessions: one row per session and one row per event, joined on session_idx.
+
+    Timestamps are int64 microseconds since the epoch (UTC); events are ordered by session_idx
+    and by position within the session.
+    """
+    sessions: pd.DataFrame
+    events: pd.DataFrame
+
+class ShardedStore(NamedTuple):
+    """A Parquet session store left on disk, to be processed out of core in session_idx ranges.
+
+    session_idx runs from 0 to session_count - 1. Each table may be a single file or a directory of part files.
+    """
+    path: Path
+    session_count: int
+
+class Funnel(NamedTuple):
+    """One funnel definition: its stage names in order and, per stage, the event names that reach it."""
+    name: str
+    stages: list
+    events: dict
+
+def load_funnels(funnels_file: str) -> list:
+    """Read funnel definitions from a JSON object of funnel name -> {stage: [event names]}.
+
+    Stages are taken in file order. Names become output directories, so they are limited to
+    letters, digits, '_' and '-'.
+    """
+    logging.info(f"Loading funnel definitions from {funnels_file}")
+    with open(funnels_file, 'r') as f:
+        definitions = json.load(f)
+    if not isinstance(definitions, dict) or not definitions:
+        raise ValueError(f"{funnels_file} must be a non-empty JSON object of funnel name -> {{stage: [events]}}")
+    for name in definitions:
+        if not _FUNNEL_NAME.fullmatch(name):
+            raise ValueError(f"Funnel name {name!r} in {funnels_file} may only use letters, digits, '_' and '-'")
+    return [Funnel(name, list(events), events) for name, events in definitions.items()]
+
+def to_epoch_us(values) -> np.ndarray:
+    """Convert ISO-8601 timestamp strings to int64 microseconds since the Unix epoch (UTC).
+
+    Naive timestamps are parsed by numpy in one pass; numpy only warns on UTC offsets (and 'Z'), and
+    those columns are parsed by pandas instead.
+    """
+    values = np.asarray(values, dtype=object)
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            return values.astype('datetime64[ns]').view(np.int64) // 1000
+    except (ValueError, UserWarning):
+        return (pd.to_datetime(pd.Series(values), format='ISO8601', utc=True).astype('int64') // 1000).to_numpy()
+
+def _iter_json_array(f) -> Iterator[dict]:
+    """Yield the elements of a top-level JSON array one at a time without loading the whole file."""
+    decoder = json.JSONDecoder()
+    buffer = f.read(READ_CHUNK_SIZE).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError("Expected a JSON array of sessions")
+    pos = 1
+    eof = False
+    while True:
+        pos = _SEPARATORS.match(buffer, pos).end()
+        if buffer.startswith(']', pos):
+            return
+        if pos < len(buffer):
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # The element is split across reads; pull in more data and retry
+                if eof:
+                    raise
+            else:
+                pos = end
+                yield item
+                continue
+        elif eof:
+            raise ValueError("Unexpected end of file while reading JSON array")
+        chunk = f.read(READ_CHUNK_SIZE)
+        eof = not chunk
+        buffer = buffer[pos:] + chunk
+        pos = 0
+
+def _loads_line(line: str):
+    """Parse one NDJSON line with orjson when available; NaN literals (stdlib output) fall back to json."""
+    if orjson is not None:
+        try:
+            return orjson.loads(line)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(line)
+
+def _iter_ndjson(f) -> Iterator[dict]:
+    """Yield one session per non-empty line of an NDJSON file."""
+    for line in f:
+        line = line.strip()
+        if line:
+            yield _loads_line(line)
+
+def _open_text(path: str):
+    """Open a session file for reading as text, decompressing gzip or zstd files detected by magic bytes."""
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(_GZIP_MAGIC):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if magic.startswith(_ZSTD_MAGIC):
+        if zstandard is None:
+            raise ImportError(f"{path} is zstd-compressed; reading it requires the zstandard package")
+        return io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True), encoding='utf-8')
+    return open(path, 'r', encoding='utf-8')
+
+def iter_sessions(sessions_file: str) -> Iterator[dict]:
+    """Stream sessions one at a time from a JSON array or NDJSON file, optionally gzip or zstd compressed."""
+    with _open_text(sessions_file) as f:
+        first = ''
+        while not first:
+            char = f.read(1)
+            if not char:
+                return
+            first = char.strip()
+    # Compressed streams cannot seek back, so the file is reopened once its format is known
+    with _open_text(sessions_file) as f:
+        if first == '[':
+            yield from _iter_json_array(f)
+        else:
+            yield from _iter_ndjson(f)
+
+def iter_batches(sessions: Iterable[dict], batch_size: int) -> Iterator[list]:
+    """Group a session iterator into lists of at most batch_size sessions."""
+    iterator = iter(sessions)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def load_session_store(store_dir: str, session_columns: list = STORE_SESSION_COLUMNS,
+                       event_columns: list = STORE_EVENT_COLUMNS, filters: list = None) -> SessionStore:
+    """Read the projected columns of a Parquet session store written by load_and_clean_data.
+
+    filters are pyarrow row filters (e.g. a session_idx range); events are sorted by session_idx, so
+    row groups outside the range are skipped without being read.
+    """
+    store_dir = Path(store_dir)
+    sessions = pd.read_parquet(store_dir / 'sessions.parquet', columns=session_columns, filters=filters)
+    events = pd.read_parquet(store_dir / 'events.parquet', columns=event_columns, filters=filters)
+    return SessionStore(sessions, events)
+
+def count_store_sessions(store_dir: str) -> int:
+    """Count the sessions in a Parquet store by reading only its session_idx column."""
+    return len(pd.read_parquet(Path(store_dir) / 'sessions.parquet', columns=['session_idx']))
+
+def load_data(sessions_file: str, funnel_events_file: str,
+              dask_threshold: Optional[int] = None) -> tuple[dict, Union[Iterator[dict], SessionStore, ShardedStore]]:
+    """Load funnel events and sessions as a lazy JSON/NDJSON stream or from a Parquet store directory.
+
+    A store with more than dask_threshold sessions is not read here; it is returned as a ShardedStore
+    for out-of-core processing.
+    """
     logging.info(f"Loading funnel events from {funnel_events_file}")
     with open(funnel_events_file, 'r') as f:
         funnel_events = json.load(f)
-    
-    logging.info(f"Loading sessions from {sessions_file}")
-    with open(sessions_file, 'r') as f:
-        sessions = json.load(f)
-    
-    return funnel_events, sessions
\ No newline at end of file
+
+    if Path(sessions_file).is_dir():
+        session_count = count_store_sessions(sessions_file)
+        if dask_threshold is not None and session_count > dask_threshold:
+            logging.info(f"Opening session store {sessions_file} ({session_count} sessions) for out-of-core processing")
+            sessions = ShardedStore(Path(sessions_file), session_count)
+        else:
+            logging.info(f"Loading session store from {sessions_file}")
+            sessions = load_session_store(sessions_file)
+    else:
+        logging.info(f"Streaming sessions from {sessions_file}")
+        sessions = iter_sessions(sessions_file)
+
+    return funnel_events, sessions
@@ -1,92 +1,320 @@
+import gzip
+import math
+import os
+import pickle
+import queue
+import tempfile
+import threading
+import time
+import numpy as np
 import pandas as pd
 import json
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import ProcessPoolExecutor
+try:
+    from .data_loader import STORE_SCHEMAS, to_epoch_us
+except ImportError:  # Run as a script (python load_and_clean_data.py) from this directory
+    from data_loader import STORE_SCHEMAS, to_epoch_us
+
+try:
+    import orjson
+except ImportError:  # Optional: NDJSON is then written with the stdlib encoder
+    orjson = None
+try:
+    import zstandard
+except ImportError:  # Optional: only needed for zstd-compressed NDJSON
+    zstandard = None
+
+CHUNK_SIZE = 100000
+# CSV chunks parsed ahead of the partitioner, so only a few chunks are ever in memory
+PREFETCH_CHUNKS = 2
+TRANSFORM_WORKERS = os.cpu_count() or 1
+# Rows of one session always share a partition; each worker process holds one partition at a time
+SESSION_KEY = ["upm_id", "session_id"]
+# Memory all sessionizing workers may use together (--memory-mb); a partition takes about
+# PARTITION_EXPANSION times its CSV size once parsed and built into session dicts
+TRANSFORM_MEMORY_BYTES = 4 * 1024 * 1024 * 1024
+PARTITION_EXPANSION = 8
+# Sessions held back by filter_session_stream until its running medians settle
+STREAMING_WARMUP = 10000
+
+# Event fields written by process_chunk, in column order for the Parquet events table
+STORE_EVENT_FIELDS = STORE_SCHEMAS["events"].names[1:]
+
+def _epoch_ns(timestamps):
+    """Epoch nanoseconds of naive or tz-aware timestamps (NaT becomes the smallest int64)."""
+    if isinstance(timestamps.dtype, pd.DatetimeTZDtype):
+        timestamps = timestamps.dt.tz_convert(None)
+    return timestamps.array.asi8
+
+def _isoformat(timestamps):
+    """Timestamp.isoformat() of every value, vectorized for whole-second timestamps that are naive or share one UTC offset."""
+    wall, suffix = timestamps, ""
+    if isinstance(timestamps.dtype, pd.DatetimeTZDtype):
+        wall = timestamps.dt.tz_localize(None)
+        offsets = np.unique(wall.array.asi8 - _epoch_ns(timestamps))
+        # A single offset reads the same after every value; isoformat() writes it right after the seconds
+        suffix = timestamps.iloc[0].isoformat()[19:] if len(offsets) == 1 else None
+    values = wall.to_numpy()
+    if (suffix is not None and values.dtype == "datetime64[ns]" and not pd.isna(values).any()
+            and (values.astype("int64") % 10**9 == 0).all()):
+        strings = np.datetime_as_string(values.astype("datetime64[s]")).tolist()
+        return [string + suffix for string in strings] if suffix else strings
+    return [timestamp.isoformat() for timestamp in timestamps]
+
+def _filled(column, fill):
+    """Column values as Python objects with missing values replaced by fill."""
+    return column.astype(object).where(column.notna(), fill).tolist()
+
+def _parsed_filters(column):
+    """Parse each distinct filters JSON string once; missing filters become []."""
+    parsed = {value: json.loads(value) for value in column.dropna().unique()}
+    return [parsed[value] if pd.notna(value) else [] for value in column.tolist()]
 
 def process_chunk(chunk, chunk_idx):
     try:
         print(f"Processing chunk {chunk_idx + 1}")
+        started = time.perf_counter()
         chunk["timestamp"] = pd.to_datetime(chunk["timestamp"])
-        grouped = chunk.groupby(["upm_id", "session_id"])
-        sessions = []
+        # One stable sort puts every session's rows together in time order; sessions follow in key order
+        session_codes = chunk.groupby(SESSION_KEY).ngroup().fillna(-1).to_numpy("int64")
+        timestamps = _epoch_ns(chunk["timestamp"])
+        order = np.lexsort((timestamps, chunk["timestamp"].isna().to_numpy(), session_codes))
+        order = order[session_codes[order] >= 0]  # Rows with a missing key belong to no session
+        rows = chunk.iloc[order]
+        session_codes = session_codes[order]
+        starts = np.flatnonzero(np.diff(session_codes, prepend=-1))
+        ends = np.append(starts[1:], len(rows))
+        
+        timestamp_strings = _isoformat(rows["timestamp"])
+        events = [
+            dict(zip(STORE_EVENT_FIELDS, values))
+            for values in zip(
+                rows["event_name"].tolist(),
+                _filled(rows["search_keyword"], ""),
+                _parsed_filters(rows["filters"]),
+                rows["page_url"].tolist(),
+                _filled(rows["product_name"], ""),
+                _filled(rows["total"], ""),
+                _filled(rows["product_inventory_status"], ""),
+                timestamp_strings
+            )
+        ]
         
-        for (upm_id, session_id), group in grouped:
-            group = group.sort_values(by="timestamp")
-            session_data = {
+        first = rows.iloc[starts]
+        sessions = [
+            {
                 "session_id": session_id,
                 "upm_id": upm_id,
-                "age": int(group["age"].iloc[0]) if not pd.isna(group["age"].iloc[0]) else None,
-                "gender": group["available_gender"].iloc[0],
-                "country": group["country"].iloc[0],
-                "start_session": group["timestamp"].iloc[0].isoformat(),
-                "end_session": group["timestamp"].iloc[-1].isoformat(),
-                "events": [
-                    {
-                        "event_name": row["event_name"],
-                        "search_keyword": row["search_keyword"] if pd.notna(row["search_keyword"]) else "",
-                        "filters": json.loads(row["filters"]) if pd.notna(row["filters"]) else [],
-                        "page_url": row["page_url"],
-                        "product_name": row["product_name"] if pd.notna(row["product_name"]) else "",
-                        "total": row["total"] if pd.notna(row["total"]) else "",
-                        "product_inventory_status": row["product_inventory_status"] if pd.notna(row["product_inventory_status"]) else "",
-                        "timestamp": row["timestamp"].isoformat()
-                    }
-                    for _, row in group.iterrows()
-                ]
+                "age": int(age) if not pd.isna(age) else None,
+                "gender": gender,
+                "country": country,
+                "start_session": timestamp_strings[start],
+                "end_session": timestamp_strings[end - 1],
+                "events": events[start:end]
             }
-            sessions.append(session_data)
-        print(f"Chunk {chunk_idx + 1} completed: {len(sessions)} sessions")
+            for session_id, upm_id, age, gender, country, start, end in zip(
+                first["session_id"].tolist(), first["upm_id"].tolist(), first["age"].tolist(),
+                first["available_gender"].tolist(), first["country"].tolist(), starts.tolist(), ends.tolist()
+            )
+        ]
+        elapsed = time.perf_counter() - started
+        print(f"Chunk {chunk_idx + 1} completed: {len(sessions)} sessions from {len(chunk)} rows "
+              f"in {elapsed:.2f}s ({len(chunk) / max(elapsed, 1e-9):,.0f} rows/s)")
         return sessions
     except Exception as e:
+        # A failed chunk would silently drop every session in it, so fail the whole transform instead
         print(f"Error in chunk {chunk_idx + 1}: {str(e)}")
-        return []
+        raise
 
-def transform_clickstream(file_path):
+def _read_chunks(file_path, chunksize, chunks):
+    """Producer: put (chunk_idx, chunk) pairs on the bounded queue, then None (or the read error)."""
+    try:
+        # Keys are read as text so a session hashes the same whichever chunk its rows are in
+        reader = pd.read_csv(file_path, chunksize=chunksize, dtype={column: str for column in SESSION_KEY})
+        for item in enumerate(reader):
+            chunks.put(item)
+        chunks.put(None)
+    except Exception as e:
+        chunks.put(e)
+
+def iter_csv_chunks(file_path, chunksize=CHUNK_SIZE, prefetch=PREFETCH_CHUNKS):
+    """
+    Stream (chunk_idx, chunk) pairs from a CSV, parsed by a reader thread at most `prefetch` chunks ahead.
+    """
+    chunks = queue.Queue(maxsize=prefetch)
+    threading.Thread(target=_read_chunks, args=(file_path, chunksize, chunks), daemon=True).start()
+    while (item := chunks.get()) is not None:
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+def partition_clickstream(file_path, spill_dir, partitions):
+    """
+    Route CSV rows to per-partition spill files by a stable hash of (upm_id, session_id).
+    
+    Every row of a session lands in the same partition whichever chunk it was read in,
+    and rows keep their file order within a partition.
+    
+    Returns:
+        list: Paths of the partition spill files, in partition order
+    """
+    paths = [os.path.join(spill_dir, f"part-{partition:05d}.pkl") for partition in range(partitions)]
+    files = [open(path, "wb") for path in paths]
+    try:
+        for chunk_idx, chunk in iter_csv_chunks(file_path):
+            started = time.perf_counter()
+            codes = pd.util.hash_pandas_object(chunk[SESSION_KEY], index=False).to_numpy() % partitions
+            for partition, rows in chunk.groupby(codes, sort=False):
+                pickle.dump(rows, files[partition], protocol=pickle.HIGHEST_PROTOCOL)
+            elapsed = time.perf_counter() - started
+            print(f"Partitioned chunk {chunk_idx + 1}: {len(chunk)} rows in {elapsed:.2f}s "
+                  f"({len(chunk) / max(elapsed, 1e-9):,.0f} rows/s)")
+    finally:
+        for f in files:
+            f.close()
+    return paths
+
+def _load_partition(partition_path):
+    """Read back and remove one partition spill file; None if no rows were routed to it."""
+    frames = []
+    with open(partition_path, "rb") as f:
+        while True:
+            try:
+                frames.append(pickle.load(f))
+            except EOFError:
+                break
+    os.remove(partition_path)
+    return pd.concat(frames) if frames else None
+
+def _spool(sessions, spool_path):
+    """Write sessions as NDJSON and return what filtering needs: (event_names, event_counts, durations)."""
+    event_names = set()
+    with open(spool_path, "w", encoding="utf-8") as f:
+        for session in sessions:
+            f.write(json.dumps(session, ensure_ascii=False) + "\n")
+            event_names.update(event["event_name"] for event in session["events"])
+    return event_names, _event_counts(sessions), _session_durations(sessions)
+
+def sessionize_partition(partition_path, spool_path, partition_idx):
+    """Worker: build every session of one partition and spool them to spool_path."""
+    rows = _load_partition(partition_path)
+    sessions = process_chunk(rows, partition_idx) if rows is not None else []
+    return _spool(sessions, spool_path)
+
+def partition_bytes(workers, memory_bytes=TRANSFORM_MEMORY_BYTES):
+    """CSV bytes per partition that keep workers partitions in flight within memory_bytes."""
+    return max(1, memory_bytes // (max(workers, 1) * PARTITION_EXPANSION))
+
+def sessionize_clickstream(file_path, work_dir, workers=TRANSFORM_WORKERS, partitions=None,
+                           memory_bytes=TRANSFORM_MEMORY_BYTES):
+    """
+    Sessionize a clickstream CSV on a process pool, building every session exactly once.
+    
+    Rows are hash-partitioned by (upm_id, session_id) into spill files under work_dir,
+    then worker processes turn whole partitions into sessions and spool them as NDJSON.
+    Only each session's event count and duration come back to this process.
+    
+    Args:
+        file_path (str): Path to the clickstream CSV
+        work_dir (str): Directory for partition and spool files
+        workers (int): Worker processes (0 or 1: sessionize in-process)
+        partitions (int): Number of partitions. Default: enough that every worker's partition fits in
+            its share of memory_bytes (see partition_bytes), at least one per worker
+        memory_bytes (int): Memory budget of all workers together, used to size the default partitions
+    
+    Returns:
+        tuple: (spool paths, event_names set, event_counts array, durations array), or None on failure
+    """
     try:
-        chunks = list(pd.read_csv(file_path, chunksize=100000))
-        print(f"Total chunks to process: {len(chunks)}")
+        started = time.perf_counter()
+        if partitions is None:
+            partitions = max(workers, math.ceil(os.path.getsize(file_path) / partition_bytes(workers, memory_bytes)))
+        partition_paths = partition_clickstream(file_path, work_dir, partitions)
+        spool_paths = [os.path.splitext(path)[0] + ".ndjson" for path in partition_paths]
+        print(f"Sessionizing {partitions} partitions with {max(workers, 1)} process(es)")
         
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            chunk_results = list(executor.map(lambda x: process_chunk(x[1], x[0]), enumerate(chunks)))
+        if workers <= 1:
+            spooled = list(map(sessionize_partition, partition_paths, spool_paths, range(partitions)))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                spooled = list(executor.map(sessionize_partition, partition_paths, spool_paths, range(partitions)))
         
-        sessions = [session for chunk_sessions in chunk_results for session in chunk_sessions if chunk_sessions]
-        print(f"Transformed {len(sessions)} sessions in total")
-        return sessions
+        event_names = set().union(*(names for names, _, _ in spooled))
+        event_counts = np.concatenate([counts for _, counts, _ in spooled])
+        durations = np.concatenate([part_durations for _, _, part_durations in spooled])
+        print(f"Transformed {len(event_counts)} sessions in total ({time.perf_counter() - started:.1f}s)")
+        return spool_paths, event_names, event_counts, durations
     except Exception as e:
         print(f"Failed to transform data: {str(e)}")
         return None
 
+@contextmanager
+def _open_spools(spool_paths):
+    """Chain the lines of several NDJSON spool files, in order."""
+    with ExitStack() as stack:
+        yield chain.from_iterable(stack.enter_context(open(path, "r", encoding="utf-8")) for path in spool_paths)
+
+def transform_clickstream(file_path):
+    with tempfile.TemporaryDirectory() as work_dir:
+        sessionized = sessionize_clickstream(file_path, work_dir)
+        if sessionized is None:
+            return None
+        with _open_spools(sessionized[0]) as lines:
+            return [json.loads(line) for line in lines]
+
+def _session_duration(session):
+    """Session length in seconds, or 0 if its timestamps cannot be parsed."""
+    try:
+        start_time = datetime.fromisoformat(session["start_session"])
+        end_time = datetime.fromisoformat(session["end_session"])
+        return (end_time - start_time).total_seconds()
+    except Exception as e:
+        print(f"Error calculating duration for session {session['session_id']}: {str(e)}")
+        return 0
+
+def _event_counts(sessions):
+    return np.fromiter((len(session["events"]) for session in sessions), dtype=np.int64, count=len(sessions))
+
+def _session_durations(sessions):
+    """Every session's length in seconds, parsing each timestamp once; 0 where it cannot be parsed."""
+    start_times = pd.to_datetime([session["start_session"] for session in sessions], format="ISO8601", utc=True, errors="coerce")
+    end_times = pd.to_datetime([session["end_session"] for session in sessions], format="ISO8601", utc=True, errors="coerce")
+    durations = (end_times - start_times).total_seconds().to_numpy(dtype=np.float64)
+    for idx in np.flatnonzero(np.isnan(durations)):
+        print(f"Error calculating duration for session {sessions[idx]['session_id']}: unparseable timestamps")
+    durations[np.isnan(durations)] = 0
+    return durations
+
+def _median(values):
+    """sorted(values)[len(values) // 2], found by O(n) selection instead of a full sort."""
+    middle = len(values) // 2
+    return np.partition(values, middle)[middle].item()
+
+def _filter_thresholds(event_counts, session_durations):
+    """Median event count and median duration; sessions must exceed both to be kept."""
+    if len(event_counts) == 0:
+        raise ValueError("No events found in sessions")
+    
+    median_event_count = _median(event_counts)
+    print(f"Median event count: {median_event_count}")
+    median_duration = _median(session_durations)
+    print(f"Median duration: {median_duration} seconds")
+    return median_event_count, median_duration
+
 def filter_sessions(sessions):
     try:
         if not sessions:
             raise ValueError("No sessions provided for filtering")
         
-        event_counts = [len(session["events"]) for session in sessions]
-        if not event_counts:
-            raise ValueError("No events found in sessions")
+        event_counts = _event_counts(sessions)
+        session_durations = _session_durations(sessions)
+        median_event_count, median_duration = _filter_thresholds(event_counts, session_durations)
         
-        median_event_count = sorted(event_counts)[len(event_counts) // 2]
-        print(f"Median event count: {median_event_count}")
-        
-        session_durations = []
-        for session in sessions:
-            try:
-                start_time = datetime.fromisoformat(session["start_session"])
-                end_time = datetime.fromisoformat(session["end_session"])
-                duration = (end_time - start_time).total_seconds()
-                session_durations.append(duration)
-            except Exception as e:
-                print(f"Error calculating duration for session {session['session_id']}: {str(e)}")
-                session_durations.append(0)
-        
-        median_duration = sorted(session_durations)[len(session_durations) // 2]
-        print(f"Median duration: {median_duration} seconds")
-        
-        filtered_sessions = [
-            session for session in sessions
-            if len(session["events"]) > median_event_count and
-            (datetime.fromisoformat(session["end_session"]) - datetime.fromisoformat(session["start_session"])).total_seconds() > median_duration
-        ]
+        keep = (event_counts > median_event_count) & (session_durations > median_duration)
+        filtered_sessions = [sessions[idx] for idx in np.flatnonzero(keep)]
         
         print(f"Filtered to {len(filtered_sessions)} sessions (from {len(sessions)})")
         return filtered_sessions
@@ -94,6 +322,120 @@ def filter_sessions(sessions):
         print(f"Failed to filter sessions: {str(e)}")
         return None
 
+def filter_spooled_sessions(spool_paths, event_counts, session_durations):
+    """
+    Filter sessions from the NDJSON spools written by sessionize_clickstream, reading them line by line.
+    
+    Same medians and rule as filter_sessions; only kept sessions are loaded.
+    """
+    try:
+        if len(event_counts) == 0:
+            raise ValueError("No sessions provided for filtering")
+        
+        median_event_count, median_duration = _filter_thresholds(event_counts, session_durations)
+        keep = (event_counts > median_event_count) & (session_durations > median_duration)
+        with _open_spools(spool_paths) as lines:
+            filtered_sessions = [json.loads(line) for line, kept in zip(lines, keep) if kept]
+        
+        print(f"Filtered to {len(filtered_sessions)} sessions (from {len(event_counts)})")
+        return filtered_sessions
+    except Exception as e:
+        print(f"Failed to filter sessions: {str(e)}")
+        return None
+
+class P2Quantile:
+    """
+    Streaming estimate of one quantile in constant memory (Jain & Chlamtac's P-square algorithm).
+    
+    Five markers track the minimum, the maximum, the target quantile and two midpoints;
+    each observation moves them by at most one position with a piecewise-parabolic fit.
+    """
+
+    def __init__(self, quantile=0.5):
+        self.quantile = quantile
+        self.count = 0
+        self.heights = []
+        self.positions = [0, 1, 2, 3, 4]
+        self.desired = [0, 2 * quantile, 4 * quantile, 2 + 2 * quantile, 4]
+        self.increments = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def add(self, value):
+        self.count += 1
+        heights = self.heights
+        if self.count <= 5:
+            heights.append(value)
+            heights.sort()
+            return
+        
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = next(i for i in range(4) if heights[i] <= value < heights[i + 1])
+        for i in range(cell + 1, 5):
+            self.positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        
+        positions = self.positions
+        for i in (1, 2, 3):
+            offset = self.desired[i] - positions[i]
+            if (offset >= 1 and positions[i + 1] - positions[i] > 1) or (offset <= -1 and positions[i - 1] - positions[i] < -1):
+                step = 1 if offset > 0 else -1
+                parabolic = heights[i] + step / (positions[i + 1] - positions[i - 1]) * (
+                    (positions[i] - positions[i - 1] + step) * (heights[i + 1] - heights[i]) / (positions[i + 1] - positions[i])
+                    + (positions[i + 1] - positions[i] - step) * (heights[i] - heights[i - 1]) / (positions[i] - positions[i - 1])
+                )
+                if heights[i - 1] < parabolic < heights[i + 1]:
+                    heights[i] = parabolic
+                else:
+                    heights[i] += step * (heights[i + step] - heights[i]) / (positions[i + step] - positions[i])
+                positions[i] += step
+
+    def value(self):
+        if self.count <= 5:
+            return self.heights[min(int(self.count * self.quantile), self.count - 1)] if self.heights else None
+        return self.heights[2]
+
+def filter_session_stream(sessions, warmup=STREAMING_WARMUP):
+    """
+    Filter a session stream in one pass against running median estimates, in bounded memory.
+    
+    Sessions are judged against P-square estimates of the median event count and duration
+    as they arrive. The first `warmup` sessions are held back until the estimates have
+    settled, so memory stays bounded by the warm-up buffer regardless of stream length.
+    
+    Yields:
+        dict: Sessions with more events and a longer duration than the estimated medians
+    """
+    median_event_count = P2Quantile(0.5)
+    median_duration = P2Quantile(0.5)
+    buffered = []
+    seen = kept = 0
+    # A trailing None flushes whatever is still buffered when the stream is shorter than the warm-up
+    for session in chain(sessions, [None]):
+        if session is not None:
+            event_count, duration = len(session["events"]), _session_duration(session)
+            median_event_count.add(event_count)
+            median_duration.add(duration)
+            buffered.append((session, event_count, duration))
+            seen += 1
+            if seen < warmup:
+                continue
+        # Event counts are integers, so their median estimate is too
+        count_threshold, duration_threshold = round(median_event_count.value()), median_duration.value()
+        for candidate, event_count, duration in buffered:
+            if event_count > count_threshold and duration > duration_threshold:
+                kept += 1
+                yield candidate
+        buffered = []
+    
+    print(f"Estimated median event count: {round(median_event_count.value())}, median duration: {median_duration.value():.1f} seconds")
+    print(f"Filtered to {kept} sessions (from {seen})")
+
 # New function to save filtered sessions to JSON
 def save_sessions_to_json(sessions, file_path="sessions.json"):
     """
@@ -122,34 +464,185 @@ def save_sessions_to_json(sessions, file_path="sessions.json"):
         print(f"Failed to save sessions to {file_path}: {str(e)}")
         return False
 
+# File suffix appended for each NDJSON compression codec
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+def _dumps_line(session):
+    """One session as a compact UTF-8 JSON line (orjson writes NaN as null)."""
+    if orjson is not None:
+        return orjson.dumps(session, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_SERIALIZE_NUMPY)
+    return (json.dumps(session, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+
+@contextmanager
+def _compressed_writer(raw, compression):
+    """Wrap a binary file object for writing with optional gzip or zstd compression."""
+    if compression is None:
+        yield raw
+    elif compression == "gzip":
+        with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6) as f:
+            yield f
+    elif compression == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd compression requires the zstandard package")
+        with zstandard.ZstdCompressor(level=3).stream_writer(raw, closefd=False) as f:
+            yield f
+    else:
+        raise ValueError(f"Unknown compression: {compression}")
+
+def save_sessions_to_ndjson(sessions, file_path="sessions.ndjson", compression=None):
+    """
+    Stream sessions to a compact NDJSON file, one session per line.
+    
+    sessions may be any iterable (e.g. filter_session_stream), so nothing has to be held
+    in memory. The file is written under a temporary name in the same directory and only
+    renamed to file_path once complete, so readers never see a partial file.
+    
+    Args:
+        sessions (iterable): Session dictionaries to save
+        file_path (str): Path to the output file. Default is 'sessions.ndjson'
+        compression (str): None, "gzip" or "zstd". Default is None
+    
+    Returns:
+        bool: True if successfully saved, False otherwise
+    """
+    tmp_path = None
+    try:
+        print(f"Saving sessions to {file_path}...")
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)), prefix=".sessions-", suffix=".tmp")
+        saved = 0
+        with os.fdopen(fd, "wb") as raw, _compressed_writer(raw, compression) as f:
+            for session in sessions:
+                f.write(_dumps_line(session))
+                saved += 1
+        if not saved:
+            print("No sessions to save")
+            os.remove(tmp_path)
+            return False
+        
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)  # mkstemp creates owner-only files
+        os.replace(tmp_path, file_path)
+        file_size_mb = round(os.path.getsize(file_path) / (1024 * 1024), 2)
+        print(f"Successfully saved {saved} sessions to {file_path} ({file_size_mb} MB)")
+        return True
+    except Exception as e:
+        print(f"Failed to save sessions to {file_path}: {str(e)}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+def save_sessions_to_parquet(sessions, dir_path="sessions_store"):
+    """
+    Save sessions as a columnar Parquet store: a sessions table and an events table.
+    
+    Both tables are keyed by an integer ``session_idx``; timestamps are stored as
+    int64 microseconds since the epoch so readers never re-parse ISO strings.
+    
+    Args:
+        sessions (list): List of session dictionaries to save
+        dir_path (str): Output directory. Default is 'sessions_store'
+    
+    Returns:
+        bool: True if successfully saved, False otherwise
+    """
+    try:
+        if not sessions:
+            print("No sessions to save")
+            return False
+        
+        print(f"Saving {len(sessions)} sessions to {dir_path}...")
+        session_rows = []
+        event_rows = []
+        for session_idx, session in enumerate(sessions):
+            session_rows.append({
+                "session_idx": session_idx,
+                "session_id": session["session_id"],
+                "upm_id": session.get("upm_id"),
+                "age": session.get("age"),
+                "gender": session.get("gender"),
+                "country": session.get("country"),
+                "start_session": session["start_session"],
+                "end_session": session["end_session"]
+            })
+            for event in session["events"]:
+                event_rows.append({"session_idx": session_idx, **event})
+        
+        sessions_df = pd.DataFrame(session_rows)
+        sessions_df["start_session"] = to_epoch_us(sessions_df["start_session"])
+        sessions_df["end_session"] = to_epoch_us(sessions_df["end_session"])
+        
+        events_df = pd.DataFrame(event_rows, columns=["session_idx", *STORE_EVENT_FIELDS])
+        events_df["timestamp"] = to_epoch_us(events_df["timestamp"])
+        events_df["filters"] = events_df["filters"].map(lambda f: json.dumps(f if isinstance(f, list) else [], ensure_ascii=False))
+        # Free-text fields mix numbers and "" in the raw data; store them uniformly as strings
+        for column in ["event_name", "search_keyword", "page_url", "product_name", "total", "product_inventory_status"]:
+            events_df[column] = events_df[column].map(lambda v: "" if v is None or v != v else str(v))
+        
+        os.makedirs(dir_path, exist_ok=True)
+        sessions_df.to_parquet(os.path.join(dir_path, "sessions.parquet"), index=False, schema=STORE_SCHEMAS["sessions"])
+        events_df.to_parquet(os.path.join(dir_path, "events.parquet"), index=False, schema=STORE_SCHEMAS["events"])
+        
+        store_size_mb = round(sum(os.path.getsize(os.path.join(dir_path, name)) for name in ("sessions.parquet", "events.parquet")) / (1024 * 1024), 2)
+        print(f"Successfully saved sessions to {dir_path} ({store_size_mb} MB)")
+        return True
+    except Exception as e:
+        print(f"Failed to save sessions to {dir_path}: {str(e)}")
+        return False
+
 if __name__ == "__main__":
-    import os  # Add this import at the top of your file
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Transform data.csv into cleaned funnel sessions")
+    parser.add_argument("--format", choices=["json", "ndjson", "parquet"], default="json",
+                        help="Output format: indented sessions.json, compact sessions.ndjson streamed as it is "
+                             "filtered, or a columnar Parquet store in sessions_store/")
+    parser.add_argument("--compress", choices=sorted(COMPRESSION_SUFFIXES), default=None,
+                        help="Compress NDJSON output (sessions.ndjson.gz or sessions.ndjson.zst)")
+    parser.add_argument("--median", choices=["exact", "streaming"], default="exact",
+                        help="Filter on exact medians (a second pass over the sessions), or on running "
+                             "estimates in one pass and bounded memory")
+    parser.add_argument("--workers", type=int, default=TRANSFORM_WORKERS,
+                        help="Sessionizing processes (0 or 1: sessionize in-process). Default: one per CPU")
+    parser.add_argument("--memory-mb", type=int, default=TRANSFORM_MEMORY_BYTES // (1024 * 1024),
+                        help="Memory budget of all sessionizing workers together; the CSV is split into "
+                             "partitions small enough for every worker to hold one within it")
+    args = parser.parse_args()
     
     file_path = "data.csv"
     print("Starting transformation...")
-    sessions = transform_clickstream(file_path)
+    # Sessions are spooled to disk by the worker processes, so only a few CSV chunks are ever in memory
+    with tempfile.TemporaryDirectory() as work_dir:
+        sessionized = sessionize_clickstream(file_path, work_dir, args.workers, memory_bytes=args.memory_mb * 1024 * 1024)
 
-    ## read the data in data.csv, get set of event_name, store in text file
-    if sessions:
-        print("Starting collecting event names...")
-        event_names = set()
-        for session in sessions:
-            for event in session["events"]:
-                event_names.add(event["event_name"])
-        
-        with open("event_names.txt", "w", encoding="utf-8") as f:
-            for event_name in sorted(event_names):
-                f.write(f"{event_name}\n")
-    if sessions:
-        print("Starting filtering...")
-        filtered_sessions = filter_sessions(sessions)
-        if filtered_sessions:
-            # Save the filtered sessions to JSON
-            if save_sessions_to_json(filtered_sessions):
-                print("Finish operation!")
+        ## read the data in data.csv, get set of event_name, store in text file
+        if sessionized:
+            spool_paths, event_names, event_counts, session_durations = sessionized
+            print("Starting collecting event names...")
+            with open("event_names.txt", "w", encoding="utf-8") as f:
+                for event_name in sorted(event_names):
+                    f.write(f"{event_name}\n")
+        if sessionized and len(event_counts):
+            print("Starting filtering...")
+            if args.format == "ndjson":
+                save = lambda sessions: save_sessions_to_ndjson(
+                    sessions, "sessions.ndjson" + COMPRESSION_SUFFIXES.get(args.compress, ""), args.compress)
             else:
-                print("Saving to JSON failed")
+                save = save_sessions_to_parquet if args.format == "parquet" else save_sessions_to_json
+            with _open_spools(spool_paths) as lines:
+                if args.median == "streaming":
+                    filtered_sessions = filter_session_stream(json.loads(line) for line in lines)
+                    # Only the NDJSON writer consumes a stream; the other formats need every session at once
+                    if args.format != "ndjson":
+                        filtered_sessions = list(filtered_sessions)
+                else:
+                    filtered_sessions = filter_spooled_sessions(spool_paths, event_counts, session_durations)
+                if filtered_sessions:
+                    if save(filtered_sessions):
+                        print("Finish operation!")
+                    else:
+                        print(f"Saving to {args.format} failed")
+                else:
+                    print("Filtering failed")
         else:
-            print("Filtering failed")
-    else:
-        print("Transformation failed")
+            print("Transformation failed")
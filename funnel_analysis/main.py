@@ -1,19 +1,185 @@
-from .data_loader import load_data
-from .processor import process_sessions
+import argparse
+import logging
+import platform
+import time
+from datetime import date, datetime, timezone
+from pathlib import Path
+from .data_loader import load_data, load_funnels, SessionStore
+from .processor import process_sessions, as_funnels, PartitionedFunnelData
+from .aggregates import compute_aggregates, compute_state, merge_states, split_funnels
 from .analyzer import analyze_funnel, segment_users, analyze_root_causes
-from .visualizer import visualize_funnel, visualize_root_causes, generate_insights
-from .config import CONFIG
-
-def main():
-    """Execute the funnel drop-off analysis."""
-    funnel_events, sessions = load_data(CONFIG['sessions_file'], CONFIG['funnel_events_file'])
-    df, stages = process_sessions(sessions, funnel_events, CONFIG['dask_threshold'])
-    stage_counts, conversion_rates, drop_off_rates = analyze_funnel(df, stages)
-    segment_users(df, stages)
-    time_spent, error_df, top_events_df, stats_df = analyze_root_causes(df, stages)
-    visualize_funnel(stage_counts, conversion_rates, drop_off_rates, stages)
-    visualize_root_causes(time_spent, error_df, top_events_df, df, stages)
-    generate_insights(df, stage_counts, drop_off_rates, error_df)
+from .visualizer import funnel_chart_jobs, root_cause_chart_jobs, render_charts, generate_insights
+from .state import save_day_state, load_day_states
+from .cube import CUBE_FILE, FunnelCube, save_cube
+from .cache import ArtifactCache
+from .profiling import Profiler, PROFILERS, REPORT_FILE
+from .config import CONFIG, OUTPUT_DIR
+
+def _session_count(data) -> int:
+    if isinstance(data, PartitionedFunnelData):
+        return data.session_count
+    return len(data.sessions)
+
+def _loaded_rows(sessions) -> int:
+    # JSON and NDJSON input is a lazy stream, read (and timed) by process_sessions
+    return len(sessions.sessions) if isinstance(sessions, SessionStore) else -1
+
+def _input_files() -> list:
+    """The files a full run reads, for its run cache key."""
+    return [CONFIG['sessions_file'], CONFIG['funnel_events_file']] + ([CONFIG['funnels_file']] if CONFIG['funnels_file'] else [])
+
+def _funnel_dirs(funnels: list) -> list:
+    """Output subdirectories of the funnels: none for a single funnel, whose outputs stay in OUTPUT_DIR."""
+    return [funnel.name for funnel in funnels] if len(funnels) > 1 else []
+
+def load_and_process(sessions_file: str, profiler: Profiler, funnel_events_file: str = CONFIG['funnel_events_file'],
+                     dask_threshold: int = CONFIG['dask_threshold']):
+    """Load sessions_file and turn it into FunnelData (or PartitionedFunnelData above dask_threshold sessions).
+
+    Returns the data and the funnels evaluated on it: those of CONFIG['funnels_file'] when set, else
+    the single funnel of funnel_events_file and CONFIG['stage_order'].
+    """
+    with profiler.span('load_data') as result:
+        funnel_events, sessions = load_data(sessions_file, funnel_events_file, dask_threshold)
+        funnels = load_funnels(CONFIG['funnels_file']) if CONFIG['funnels_file'] else as_funnels(funnel_events)
+        result['rows'] = _loaded_rows(sessions)
+    with profiler.span('process_sessions') as result:
+        data, _ = process_sessions(sessions, funnels, dask_threshold, CONFIG['batch_size'])
+        result['rows'] = _session_count(data)
+    return data, funnels
+
+def write_outputs(aggregates: dict, stages: list, data=None, cache: ArtifactCache = None, profiler: Profiler = None,
+                  charts: bool = True, output_dir: Path = OUTPUT_DIR):
+    """Write every CSV, chart (unless charts is False), the funnel cube and the insights summary from the aggregates."""
+    profiler = profiler or Profiler()
+    output_dir.mkdir(exist_ok=True)
+    with profiler.span('analyze_funnel') as result:
+        stage_counts, conversion_rates, drop_off_rates = analyze_funnel(aggregates, stages, output_dir)
+        result['rows'] = len(stage_counts)
+    with profiler.span('segment_users') as result:
+        result['rows'] = len(segment_users(aggregates, stages, output_dir))
+    with profiler.span('analyze_root_causes') as result:
+        time_spent, error_df, top_events_df, stats_df = analyze_root_causes(aggregates, stages, output_dir)
+        result['rows'] = len(stats_df)
+    if charts:
+        with profiler.span('render_charts') as result:
+            # Every chart is an independent job, so both chart sets share one rendering pool
+            jobs = (funnel_chart_jobs(stage_counts, conversion_rates, drop_off_rates, stages)
+                    + root_cause_chart_jobs(time_spent, error_df, top_events_df, aggregates, stages))
+            render_charts(jobs, CONFIG['render_workers'], cache, profiler, output_dir)
+            result['rows'] = len(jobs)
+    with profiler.span('generate_insights'):
+        generate_insights(data, stage_counts, drop_off_rates, error_df, output_dir)
+    with profiler.span('save_cube') as result:
+        cube = FunnelCube.from_metrics(aggregates['cube'])
+        save_cube(cube, output_dir / CUBE_FILE.name)
+        result['rows'] = len(cube.cells)
+
+def write_funnel_outputs(aggregates: dict, funnels: list, data=None, cache: ArtifactCache = None,
+                         profiler: Profiler = None, charts: bool = True):
+    """Write the outputs of every funnel evaluated together: into OUTPUT_DIR for a single funnel, else
+    into one OUTPUT_DIR/<funnel name> directory per funnel."""
+    profiler = profiler or Profiler()
+    if len(funnels) == 1:
+        write_outputs(aggregates, funnels[0].stages, data, cache, profiler, charts)
+        return
+    split = split_funnels(aggregates, funnels)
+    for funnel in funnels:
+        with profiler.labelled(funnel=funnel.name):
+            write_outputs(split[funnel.name], funnel.stages, data, cache, profiler, charts, OUTPUT_DIR / funnel.name)
+
+def _report_metadata(mode: str, started: datetime) -> dict:
+    return {
+        'mode': mode,
+        'started': started.isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': CONFIG
+    }
+
+def main(profiler: Profiler = None, report_file=REPORT_FILE, charts: bool = True):
+    """Execute the funnel drop-off analysis, recording a span per phase and chart in a run report.
+
+    With charts=False only the CSVs, cube and insights are written and the plotting stack is never imported.
+    """
+    profiler = profiler or Profiler()
+    started = datetime.now(timezone.utc)
+    try:
+        _analyze(profiler, charts)
+    finally:
+        profiler.save(report_file, _report_metadata('full' if charts else 'full, no charts', started))
+
+def _analyze(profiler: Profiler, charts: bool):
+    cache = ArtifactCache(CONFIG['cache_dir']) if CONFIG['cache_dir'] else None
+    if cache is not None:
+        with profiler.span('restore_cache'):
+            # Unchanged inputs and code reproduce the last run's outputs exactly, so copy them back
+            run_key = cache.run_key(_input_files(), {'charts': charts})
+            restored = cache.restore_run(run_key)
+        if restored:
+            logging.info("Inputs and code unchanged; restored all outputs from cache")
+            return
+    started = time.time()
+
+    data, funnels = load_and_process(CONFIG['sessions_file'], profiler)
+    with profiler.span('compute_aggregates'):
+        aggregates = compute_aggregates(data)
+    write_funnel_outputs(aggregates, funnels, data, cache, profiler, charts)
+
+    if cache is not None:
+        with profiler.span('store_cache'):
+            cache.store_run(run_key, started, _funnel_dirs(funnels))
+
+def run_incremental(delta_file: str, day: str, state_dir: str = CONFIG['state_dir'], profiler: Profiler = None,
+                    report_file=REPORT_FILE, charts: bool = True):
+    """Fold one day's sessions into the per-day aggregate state and regenerate every output from it.
+
+    Only delta_file is processed; earlier days contribute their small saved state. Rerunning a day replaces its state.
+    """
+    profiler = profiler or Profiler()
+    started = datetime.now(timezone.utc)
+    try:
+        data, funnels = load_and_process(delta_file, profiler)
+        with profiler.span('compute_state'):
+            state = compute_state(data)
+        with profiler.span('save_day_state'):
+            save_day_state(state, state_dir, day)
+
+        with profiler.span('load_day_states') as result:
+            states = load_day_states(state_dir)
+            result['rows'] = len(states)
+        logging.info(f"Merging aggregate state of {len(states)} days")
+        with profiler.span('merge_states'):
+            aggregates = merge_states(list(states.values()))
+        cache = ArtifactCache(CONFIG['cache_dir']) if CONFIG['cache_dir'] else None
+        write_funnel_outputs(aggregates, funnels, cache=cache, profiler=profiler, charts=charts)
+        if cache is not None:
+            cache.save()
+    finally:
+        profiler.save(report_file, _report_metadata(f'incremental {day}', started))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Funnel drop-off analysis")
+    parser.add_argument("--delta", help="Sessions file of one daily drop to merge into the incremental state "
+                                        "(default: analyze CONFIG['sessions_file'] in full)")
+    parser.add_argument("--day", type=date.fromisoformat, help="Day of the --delta drop, YYYY-MM-DD")
+    parser.add_argument("--no-charts", action="store_true",
+                        help="Metrics only: write the CSVs, cube and insights but no charts, without importing the plotting stack")
+    parser.add_argument("--report", default=str(REPORT_FILE),
+                        help="Run report of per-phase timings (JSON; a CSV is written next to it)")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="Record each phase's peak traced allocation with tracemalloc (slows the run)")
+    parser.add_argument("--profile-phase", metavar="PHASE",
+                        help="Profile one span in detail, e.g. process_sessions, or chart:funnel_chart.png when "
+                             "CONFIG['render_workers'] is 0 or 1; the dump is written next to the report")
+    parser.add_argument("--profiler", choices=PROFILERS, default="cprofile",
+                        help="Detail profiler for --profile-phase (pyinstrument must be installed)")
+    args = parser.parse_args()
+    if args.delta and args.day is None:
+        parser.error("--delta requires --day")
+    profiler = Profiler(args.trace_memory, args.profile_phase, args.profiler, Path(args.report).parent)
+    if args.delta:
+        run_incremental(args.delta, args.day.isoformat(), profiler=profiler, report_file=args.report,
+                        charts=not args.no_charts)
+    else:
+        main(profiler, args.report, not args.no_charts)
@@ -1,12 +1,14 @@
-## read sessions.json
+## read sessions.json (a JSON array, or NDJSON written by load_and_clean_data.py --format ndjson, optionally compressed)
 import json
 import random 
+import sys
+from data_loader import iter_sessions
 
-with open("sessions.json", "r", encoding="utf-8") as f:
-    sessions = json.load(f)
-    ## get random 10 sessions
-    random_sessions = random.sample(sessions, 300)
-    ## save to sample_sessions.json
-    with open("sample_sessions.json", "w", encoding="utf-8") as f:
-        json.dump(random_sessions, f, ensure_ascii=False, indent=2)
-        print("Random sessions saved to sample_sessions.json")
\ No newline at end of file
+sessions_file = sys.argv[1] if len(sys.argv) > 1 else "sessions.json"
+sessions = list(iter_sessions(sessions_file))
+## get random 10 sessions
+random_sessions = random.sample(sessions, 300)
+## save to sample_sessions.json
+with open("sample_sessions.json", "w", encoding="utf-8") as f:
+    json.dump(random_sessions, f, ensure_ascii=False, indent=2)
+    print("Random sessions saved to sample_sessions.json")
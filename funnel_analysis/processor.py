@@ -1,52 +1,432 @@
+import atexit
+import math
+import os
+import re
+import shutil
+import sys
+import tempfile
+from itertools import chain
+from operator import itemgetter
+from pathlib import Path
 import pandas as pd
-import dask.dataframe as dd
-from datetime import datetime
+import numpy as np
+import pyarrow as pa
+from pandas.api.types import union_categoricals
 import logging
+from typing import TYPE_CHECKING, Iterable, NamedTuple, Union
 from .config import CONFIG
+from .data_loader import (STORE_EVENT_COLUMNS, STORE_SCHEMAS, STORE_SESSION_COLUMNS, Funnel, SessionStore, ShardedStore,
+                          iter_batches, load_session_store, to_epoch_us)
+
+if TYPE_CHECKING:
+    import dask.dataframe as dd
+    from scipy import sparse
+
+# Spilled shards hold the projected store columns with their store types, so every part file shares one Parquet schema
+_SPILL_SCHEMAS = {name: pa.schema([STORE_SCHEMAS[name].field(column) for column in columns])
+                  for name, columns in (('sessions', STORE_SESSION_COLUMNS), ('events', STORE_EVENT_COLUMNS))}
+
+def _flatten_batch(batch: list, first_idx: int) -> SessionStore:
+    """Flatten a batch of session dicts into the columnar SessionStore layout.
+
+    Every event field is gathered once straight into an object array (pandas would otherwise re-scan
+    each list to infer its type) and timestamps are converted a whole column at a time. Event names and
+    URLs are categorical, so a batch held until the spill decision costs a few bytes per event rather
+    than a string object each.
+    """
+    session_idx = np.arange(first_idx, first_idx + len(batch))
+    sessions = pd.DataFrame({
+        'session_idx': session_idx,
+        'session_id': [session['session_id'] for session in batch],
+        'start_session': to_epoch_us([session['start_session'] for session in batch]),
+        'end_session': to_epoch_us([session['end_session'] for session in batch]),
+        'age': [session.get('age') for session in batch],
+        'gender': [session.get('gender') for session in batch],
+        'country': [session.get('country') for session in batch]
+    })
+    events = list(chain.from_iterable(map(itemgetter('events'), batch)))
+    count = len(events)
+    events = pd.DataFrame({
+        'session_idx': np.repeat(session_idx, [len(session['events']) for session in batch]),
+        'event_name': pd.Categorical(np.fromiter(map(itemgetter('event_name'), events), dtype=object, count=count)),
+        'timestamp': to_epoch_us(np.fromiter(map(itemgetter('timestamp'), events), dtype=object, count=count)),
+        'page_url': pd.Categorical(np.fromiter((event.get('page_url', 'N/A') for event in events), dtype=object, count=count))
+    })
+    return SessionStore(sessions, events)
+
+def as_funnels(funnel_events) -> list:
+    """Funnel definitions from a list of Funnel, or from one funnel_events dict staged by CONFIG['stage_order']."""
+    if isinstance(funnel_events, dict):
+        return [Funnel('funnel', CONFIG['stage_order'], funnel_events)]
+    return list(funnel_events)
+
+def stage_labels(funnels: list) -> list:
+    """The stage key of every (funnel, stage): plain stage names for one funnel, 'funnel:stage' for several."""
+    if len(funnels) == 1:
+        return list(funnels[0].stages)
+    return [f"{funnel.name}:{stage}" for funnel in funnels for stage in funnel.stages]
+
+def _stage_lookup(funnels: list, vocabulary: pd.Index) -> np.ndarray:
+    """Boolean (event code x stage label) matrix marking every funnel stage each event name belongs to.
+
+    The extra last row is all False so that the -1 code pandas gives missing names never hits.
+    """
+    lookup = np.zeros((len(vocabulary) + 1, sum(len(funnel.stages) for funnel in funnels)), dtype=bool)
+    stage_code = 0
+    for funnel in funnels:
+        for stage in funnel.stages:
+            if stage in funnel.events:  # Skip stages without events
+                lookup[vocabulary.get_indexer(funnel.events[stage]), stage_code] = True
+            stage_code += 1
+    lookup[-1] = False  # get_indexer returns -1 for names absent from this data
+    return lookup
+
+def _first_hits(codes: np.ndarray, event_session: np.ndarray, lookup: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Event position and stage code of each (session, stage) first hit, ordered by session and then stage.
+
+    Events matching any stage are found in one pass and expanded to every stage their name belongs
+    to, so the cost grows with the matching events rather than with the number of funnels.
+    """
+    stage_counts = lookup.sum(axis=1)
+    positions = np.flatnonzero(stage_counts[codes])
+    matched_codes = codes[positions]
+    counts = stage_counts[matched_codes]
+    # Stage codes of each event code, CSR-style: the columns of its True cells in row-major order
+    rows, stage_codes = np.nonzero(lookup)
+    row_start = np.searchsorted(rows, np.arange(len(lookup)))
+    expanded = np.repeat(positions, counts)
+    offsets = np.arange(len(expanded)) - np.repeat(np.cumsum(counts) - counts, counts)
+    hit_stage = stage_codes[np.repeat(row_start[matched_codes], counts) + offsets]
+    # Events are ordered within each session, so the first occurrence of a key is the earliest hit
+    keys = event_session[expanded].astype(np.int64) * lookup.shape[1] + hit_stage
+    _, first = np.unique(keys, return_index=True)
+    return expanded[first], hit_stage[first]
+
+class FunnelData(NamedTuple):
+    """Processed sessions in normalized form.
+
+    sessions: one row per session (session_idx, session_id, duration, age, gender, country, day of its
+        UTC start) with event_start/event_end offsets into events.
+    hits: one slim row per (session, stage) reached: session_idx, stage, time_to_stage, url, timestamp.
+    events: every event name of every session, flattened in session order.
+    session_ids: original session id strings, indexed by the integer session_id codes.
+
+    String columns (stage, url, gender, country, events) are categoricals; stage is ordered by the
+    stage labels of the funnels (CONFIG['stage_order'] for a single funnel) and the others use sorted
+    dictionaries. With several funnels hits also carry the funnel name of each stage.
+    """
+    sessions: pd.DataFrame
+    hits: pd.DataFrame
+    events: pd.Series
+    session_ids: pd.Index = None
+
+    def incidence(self) -> 'sparse.csr_matrix':
+        """Binary session x event-code matrix, rows in sessions order, marking every event a session contains."""
+        from scipy import sparse
+        counts = (self.sessions['event_end'] - self.sessions['event_start']).to_numpy()
+        rows = np.repeat(np.arange(len(self.sessions)), counts)
+        codes = self.events.cat.codes.to_numpy()
+        known = codes >= 0
+        incidence = sparse.csr_matrix((np.ones(known.sum(), dtype=np.int32), (rows[known], codes[known])),
+                                      shape=(len(self.sessions), len(self.events.cat.categories)))
+        incidence.data[:] = 1  # Repeats of an event within a session were summed
+        return incidence
+
+class StageEventTables(NamedTuple):
+    """Per-stage event tables derived from the session x event incidence matrix.
+
+    events: (stage, event) and error_types: (stage, error_type) with their distinct sessions in a
+        'sessions' column; with CONFIG['distinct_error'] set, one (stage, session_id, event or
+        error_type) row per distinct session instead, for HyperLogLog sketches.
+    event_pairs: (stage, event, co_event) with the sessions containing both events (event < co_event),
+        always counted exactly.
+    """
+    events: pd.DataFrame
+    error_types: pd.DataFrame
+    event_pairs: pd.DataFrame
+
+class PartitionedFunnelData(NamedTuple):
+    """Out-of-core processed sessions: lazy Dask frames built per session_idx range of a ShardedStore.
+
+    hits: one row per (session, stage) already joined with session_id, duration, age, gender, country, day and has_error.
+    tables: the StageEventTables behind top-events, error-type and co-occurrence metrics, one set of rows per partition.
+
+    Only stage stays categorical; the other strings are plain objects since partition dictionaries differ.
+    """
+    hits: 'dd.DataFrame'
+    tables: StageEventTables
+    session_count: int
+
+def is_dask(obj) -> bool:
+    """Whether obj is a Dask frame or series.
+
+    Dask is imported only on the out-of-core path, so while dask.dataframe is not loaded nothing can be one.
+    """
+    dd = sys.modules.get('dask.dataframe')
+    return dd is not None and isinstance(obj, (dd.DataFrame, dd.Series))
+
+def error_types(vocabulary: pd.Index, patterns: dict = None) -> np.ndarray:
+    """Error type code of each event name in vocabulary (-1 when it is not an error), one regex search per name.
+
+    patterns maps error types to regular expressions (CONFIG['error_patterns']), searched case-insensitively
+    as one compiled alternation; a name matching several types takes the one matching earliest in the
+    name, and on a tie the first listed.
+    """
+    patterns = CONFIG['error_patterns'] if patterns is None else patterns
+    if not patterns:
+        return np.full(len(vocabulary), -1, dtype=np.int64)
+    matcher = re.compile('|'.join(f'(?P<_{code}>{pattern})' for code, pattern in enumerate(patterns.values())),
+                         re.IGNORECASE)
+    matches = (matcher.search(str(name)) for name in vocabulary)
+    return np.fromiter((int(match.lastgroup[1:]) if match else -1 for match in matches), dtype=np.int64,
+                       count=len(vocabulary))
+
+def _stage_counts(membership: 'sparse.csr_matrix', incidence: 'sparse.csr_matrix', stage_dtype, key: str,
+                  categories) -> pd.DataFrame:
+    """Distinct sessions per (stage, incidence column), from one sparse product with the stage membership."""
+    counts = (membership.T @ incidence).tocoo()
+    return pd.DataFrame({
+        'stage': pd.Categorical.from_codes(counts.row, dtype=stage_dtype),
+        key: pd.Categorical.from_codes(counts.col, categories=categories),
+        'sessions': counts.data.astype(np.int64)
+    })
+
+def _stage_rows(position: np.ndarray, stage: np.ndarray, incidence: 'sparse.csr_matrix') -> tuple[np.ndarray, ...]:
+    """Stage, session position and column of every incidence entry, repeated for each stage hit of its session."""
+    counts = np.diff(incidence.indptr)[position]
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    columns = incidence.indices[np.repeat(incidence.indptr[position], counts) + offsets]
+    return np.repeat(stage, counts), np.repeat(position, counts), columns
+
+def _stage_session_rows(data: FunnelData, position: np.ndarray, stage: np.ndarray, incidence: 'sparse.csr_matrix',
+                        key: str, categories) -> pd.DataFrame:
+    """Distinct (stage, session_id, incidence column) rows, the input of sketched distinct counts."""
+    stage, position, columns = _stage_rows(position, stage, incidence)
+    return pd.DataFrame({
+        'stage': pd.Categorical.from_codes(stage, dtype=data.hits['stage'].dtype),
+        'session_id': data.sessions['session_id'].array.take(position),
+        key: pd.Categorical.from_codes(columns, categories=categories)
+    })
+
+def _stage_event_pairs(membership: 'sparse.csr_matrix', incidence: 'sparse.csr_matrix', stage_dtype,
+                       vocabulary: pd.Index) -> pd.DataFrame:
+    """Sessions containing each pair of distinct events, per stage: the upper triangle of X_s.T @ X_s for
+    the incidence rows X_s of the sessions that reached stage s. Empty unless CONFIG['event_pairs']."""
+    from scipy import sparse
+    by_stage = membership.T.tocsr()
+    parts = [(np.empty(0, dtype=np.int64),) * 4]
+    for stage in range(by_stage.shape[0]) if CONFIG['event_pairs'] else ():
+        reached = incidence[by_stage.indices[by_stage.indptr[stage]:by_stage.indptr[stage + 1]]]
+        pairs = sparse.triu(reached.T @ reached, k=1).tocoo()
+        parts.append((np.full(pairs.nnz, stage), pairs.row, pairs.col, pairs.data))
+    stage, event, co_event, sessions = (np.concatenate(column) for column in zip(*parts))
+    return pd.DataFrame({
+        'stage': pd.Categorical.from_codes(stage.astype(np.int64), dtype=stage_dtype),
+        'event': pd.Categorical.from_codes(event.astype(np.int64), categories=vocabulary),
+        'co_event': pd.Categorical.from_codes(co_event.astype(np.int64), categories=vocabulary),
+        'sessions': sessions.astype(np.int64)
+    })
+
+def stage_inputs(data: FunnelData) -> tuple[pd.DataFrame, StageEventTables]:
+    """Build the analysis inputs: hits joined with session columns and an error flag, and the per-stage event tables.
+
+    Everything event-level comes from one session x event incidence matrix. Per-stage counts are sparse
+    products of it with the sessions' stage membership, so hits are never joined to every event of
+    their session (except for the rows HyperLogLog sketches need).
+    """
+    from scipy import sparse
+    incidence = data.incidence()
+    vocabulary = data.events.cat.categories
+    # Patterns are matched once per distinct event name; an event-code x error-type indicator then gives
+    # every session's error types in one product
+    types = error_types(vocabulary)
+    type_names = list(CONFIG['error_patterns'])
+    is_error = np.flatnonzero(types >= 0)
+    indicator = sparse.csr_matrix((np.ones(len(is_error), dtype=np.int32), (is_error, types[is_error])),
+                                  shape=(len(vocabulary), len(type_names)))
+    session_errors = incidence @ indicator
+    session_errors.data[:] = 1
+    sessions = data.sessions.assign(has_error=session_errors.getnnz(axis=1) > 0)
+    df = data.hits.merge(sessions[['session_idx', 'session_id', 'duration', 'age', 'gender', 'country', 'day', 'has_error']],
+                         on='session_idx', how='left')
+
+    position = np.searchsorted(data.sessions['session_idx'].to_numpy(), data.hits['session_idx'].to_numpy())
+    stage = data.hits['stage'].cat.codes.to_numpy()
+    stage_dtype = data.hits['stage'].dtype
+    membership = sparse.csr_matrix((np.ones(len(position), dtype=np.int32), (position, stage)),
+                                   shape=(len(data.sessions), len(stage_dtype.categories)))
+    if CONFIG['distinct_error'] is None:
+        events = _stage_counts(membership, incidence, stage_dtype, 'event', vocabulary)
+        errors = _stage_counts(membership, session_errors, stage_dtype, 'error_type', type_names)
+    else:
+        events = _stage_session_rows(data, position, stage, incidence, 'event', vocabulary)
+        errors = _stage_session_rows(data, position, stage, session_errors, 'error_type', type_names)
+    return df, StageEventTables(events, errors, _stage_event_pairs(membership, incidence, stage_dtype, vocabulary))
+
+def _normalize(store: SessionStore, funnels: list) -> FunnelData:
+    """Split a session store into normalized tables, finding each (session, stage) first hit with array operations."""
+    sessions = store.sessions.sort_values('session_idx', kind='stable')
+    events = store.events
+    if not events['session_idx'].is_monotonic_increasing:
+        events = events.sort_values('session_idx', kind='stable')
+    event_session = events['session_idx'].to_numpy()
+
+    # Sorted dictionaries keep categorical groupbys in the same key order as plain strings
+    codes, vocabulary = pd.factorize(np.asarray(events['event_name'], dtype=object), sort=True)
+    vocabulary = pd.Index(vocabulary)
+    hit_pos, hit_stage = _first_hits(codes, event_session, _stage_lookup(funnels, vocabulary))
+
+    session_idx = sessions['session_idx'].to_numpy()
+    start = sessions['start_session'].to_numpy()
+    hit_time = events['timestamp'].to_numpy()[hit_pos]
+    hits = pd.DataFrame({
+        'session_idx': event_session[hit_pos],
+        'stage': pd.Categorical.from_codes(hit_stage, categories=stage_labels(funnels), ordered=True),
+        'time_to_stage': (hit_time - start[np.searchsorted(session_idx, event_session[hit_pos])]) / 1e6,
+        'url': pd.Categorical(np.asarray(events['page_url'], dtype=object)[hit_pos]),
+        'timestamp': pd.to_datetime(hit_time, unit='us')
+    })
+    if len(funnels) > 1:
+        funnel_codes = np.repeat(np.arange(len(funnels)), [len(funnel.stages) for funnel in funnels])
+        hits['funnel'] = pd.Categorical.from_codes(funnel_codes[hit_stage], categories=[f.name for f in funnels])
+    session_table = pd.DataFrame({
+        'session_idx': session_idx,
+        'session_id': pd.Categorical(np.asarray(sessions['session_id'], dtype=object)),
+        'duration': (sessions['end_session'].to_numpy() - start) / 1e6,
+        'age': sessions['age'].to_numpy(),
+        'gender': pd.Categorical(np.asarray(sessions['gender'], dtype=object)),
+        'country': pd.Categorical(np.asarray(sessions['country'], dtype=object)),
+        'day': pd.to_datetime(start // 86_400_000_000, unit='D'),
+        'event_start': np.searchsorted(event_session, session_idx, side='left'),
+        'event_end': np.searchsorted(event_session, session_idx, side='right')
+    })
+    return FunnelData(session_table, hits, pd.Series(pd.Categorical.from_codes(codes, categories=vocabulary)))
+
+def _union(columns: list) -> pd.Categorical:
+    """Concatenate per-batch categoricals under one sorted dictionary."""
+    return union_categoricals(columns, sort_categories=True)
+
+def _concat(parts: list) -> FunnelData:
+    """Concatenate per-batch FunnelData, shifting event offsets into the combined event array."""
+    sessions = []
+    event_offset = 0
+    for part in parts:
+        shifted = part.sessions.copy()
+        shifted[['event_start', 'event_end']] += event_offset
+        sessions.append(shifted)
+        event_offset += len(part.events)
+    sessions = pd.concat(sessions, ignore_index=True)
+    hits = pd.concat([part.hits for part in parts], ignore_index=True)
+    for column in ['session_id', 'gender', 'country']:
+        sessions[column] = _union([part.sessions[column] for part in parts])
+    hits['url'] = _union([part.hits['url'] for part in parts])
+    return FunnelData(sessions, hits, pd.Series(_union([part.events for part in parts])))
+
+def _encode_session_ids(data: FunnelData) -> FunnelData:
+    """Replace the session_id categorical with its integer codes, keeping the id dictionary on the side."""
+    session_id = data.sessions['session_id']
+    sessions = data.sessions.assign(session_id=session_id.cat.codes)
+    return data._replace(sessions=sessions, session_ids=session_id.cat.categories)
+
+def _plain(frame: pd.DataFrame) -> pd.DataFrame:
+    """Turn partition-local categoricals (all but stage) into objects so partitions share one schema."""
+    columns = {column: object for column, dtype in frame.dtypes.items()
+               if isinstance(dtype, pd.CategoricalDtype) and column != 'stage'}
+    if 'age' in frame:
+        columns['age'] = 'float64'
+    return frame.astype(columns)
+
+def _partition_inputs(store_dir: Path, lo: int, hi: int, funnels: list) -> tuple[pd.DataFrame, ...]:
+    """Normalize the sessions with lo <= session_idx < hi and return their hits and stage event tables."""
+    store = load_session_store(store_dir, filters=[('session_idx', '>=', lo), ('session_idx', '<', hi)])
+    df, tables = stage_inputs(_normalize(store, funnels))
+    return (_plain(df), *(_plain(table) for table in tables))
+
+def _partition_count(session_count: int) -> int:
+    """Enough partitions to keep every core busy and each partition near CONFIG['partition_sessions'] sessions."""
+    wanted = max(os.cpu_count() or 1, math.ceil(session_count / CONFIG['partition_sessions']))
+    return max(1, min(session_count, wanted))
+
+def _process_partitioned(store: ShardedStore, funnels: list) -> PartitionedFunnelData:
+    """Build lazy per-partition hits and stage events; nothing is read until the aggregates are computed."""
+    import dask
+    import dask.dataframe as dd
+    npartitions = _partition_count(store.session_count)
+    bounds = np.linspace(0, store.session_count, npartitions + 1).astype(int)
+    logging.info(f"Processing {store.session_count} sessions out of core in {npartitions} partitions")
+    meta = _partition_inputs(store.path, 0, 0, funnels)
+    # All frames come from the same delayed tasks, so one dask.compute reads each partition once
+    parts = [dask.delayed(_partition_inputs, nout=len(meta))(store.path, lo, hi, funnels)
+             for lo, hi in zip(bounds[:-1], bounds[1:])]
+    hits, *tables = [dd.from_delayed([part[i] for part in parts], meta=frame) for i, frame in enumerate(meta)]
+    return PartitionedFunnelData(hits, StageEventTables(*tables), store.session_count)
+
+def _as_text(series: pd.Series) -> pd.Series:
+    """Render values as strings, keeping missing values as None."""
+    return series.map(lambda v: None if v is None or v != v else str(v))
+
+def _spill(batch: SessionStore, spill_dir: Path, shard: int):
+    """Write one flattened batch as a part file of each table of an on-disk session store."""
+    for name, frame in (('sessions', batch.sessions), ('events', batch.events)):
+        frame = frame.copy()
+        for field in _SPILL_SCHEMAS[name]:
+            if field.type == pa.string():
+                frame[field.name] = _as_text(frame[field.name])
+        part_dir = spill_dir / f'{name}.parquet'
+        part_dir.mkdir(parents=True, exist_ok=True)
+        frame.to_parquet(part_dir / f'part-{shard:05d}.parquet', index=False, schema=_SPILL_SCHEMAS[name])
+
+def _spill_dir() -> Path:
+    """Create a temporary shard directory that is removed when the interpreter exits."""
+    spill_dir = Path(tempfile.mkdtemp(prefix='funnel_spill_', dir=CONFIG['spill_dir']))
+    atexit.register(shutil.rmtree, spill_dir, ignore_errors=True)
+    return spill_dir
+
+def process_sessions(sessions: Union[Iterable[dict], SessionStore, ShardedStore], funnel_events: Union[dict, list],
+                     dask_threshold: int, batch_size: int = CONFIG['batch_size']) -> tuple[Union[FunnelData, PartitionedFunnelData], list]:
+    """Process sessions into normalized session, hit and event tables, returned with their stage labels.
+
+    Input is a session stream (read batch by batch), an in-memory columnar store, or a ShardedStore.
+    Above dask_threshold sessions, processing runs out of core on Dask partitions; a stream is first
+    spilled to Parquet shards once it crosses the threshold.
+
+    funnel_events is one funnel's {stage: [event names]}, staged by CONFIG['stage_order'], or a list
+    of Funnel definitions. Every funnel is evaluated in the same pass over the events; see stage_labels.
+    """
+    funnels = as_funnels(funnel_events)
+    stages = stage_labels(funnels)
 
-def process_sessions(sessions: list, funnel_events: dict, dask_threshold: int) -> tuple[pd.DataFrame, list]:
-    """Process sessions into a DataFrame with event sequences, timing, and URLs."""
-    stages = CONFIG['stage_order']  # Use the defined stage order
-    events_list = []
-    
     logging.info("Processing sessions for funnel stages")
-    for session in sessions:
-        session_id = session['session_id']
-        start_time = datetime.fromisoformat(session['start_session'].replace('Z', '+00:00'))
-        end_time = datetime.fromisoformat(session['end_session'].replace('Z', '+00:00'))
-        duration = (end_time - start_time).total_seconds()
-        events = session['events']
-        
-        event_data = [(event['event_name'], datetime.fromisoformat(event['timestamp'].replace('Z', '+00:00')),
-                       event.get('page_url', 'N/A')) for event in events]
-        event_names = [e[0] for e in event_data]
-        event_timestamps = [e[1] for e in event_data]
-        event_urls = [e[2] for e in event_data]
-        
-        for stage in stages:
-            if stage not in funnel_events:
-                continue  # Skip stages not in funnel_events
-            stage_events = set(funnel_events[stage])
-            stage_hits = [i for i, event in enumerate(event_names) if event in stage_events]
-            if stage_hits:
-                first_hit = min(stage_hits)
-                time_to_stage = (event_timestamps[first_hit] - start_time).total_seconds()
-                events_list.append({
-                    'session_id': session_id,
-                    'stage': stage,
-                    'time_to_stage': time_to_stage,
-                    'duration': duration,
-                    'events': event_names,
-                    'url': event_urls[first_hit],
-                    'timestamp': event_timestamps[first_hit],
-                    'age': session.get('age'),
-                    'gender': session.get('gender'),
-                    'country': session.get('country')
-                })
-    
-    df = pd.DataFrame(events_list)
-    if len(sessions) > dask_threshold:
-        logging.info("Switching to Dask for large dataset processing")
-        df = dd.from_pandas(df, npartitions=8)
-    
-    return df, stages
\ No newline at end of file
+    if isinstance(sessions, ShardedStore):
+        return _process_partitioned(sessions, funnels), stages
+    if isinstance(sessions, SessionStore):
+        data = _normalize(sessions, funnels)
+    else:
+        # Flattened batches are held only until it is known whether the stream stays under the threshold;
+        # then each is normalized and released in turn, so the raw and normalized columns of the whole
+        # input are never in memory together
+        batches = []
+        spill_dir = None
+        shard = 0
+        session_count = 0
+        for batch in iter_batches(sessions, batch_size):
+            batches.append(_flatten_batch(batch, session_count))
+            session_count += len(batch)
+            if session_count > dask_threshold:
+                if spill_dir is None:
+                    spill_dir = _spill_dir()
+                    logging.info(f"More than {dask_threshold} sessions; spilling shards to {spill_dir}")
+                for held in batches:
+                    _spill(held, spill_dir, shard)
+                    shard += 1
+                batches = []
+        if spill_dir is not None:
+            return _process_partitioned(ShardedStore(spill_dir, session_count), funnels), stages
+        parts = []
+        while batches:
+            parts.append(_normalize(batches.pop(0), funnels))
+        data = _concat(parts) if parts else _normalize(_flatten_batch([], 0), funnels)
+    data = _encode_session_ids(data)
+
+    logging.info(f"Processed {len(data.sessions)} sessions into {len(data.hits)} stage hits over {len(data.events)} events")
+    return data, stages
@@ -0,0 +1,169 @@
+import cProfile
+import csv
+import io
+import json
+import logging
+import math
+import os
+import platform
+import pstats
+import re
+import resource
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import NamedTuple
+from .config import OUTPUT_DIR
+
+try:
+    import pyinstrument
+except ImportError:  # optional: only needed for --profiler pyinstrument
+    pyinstrument = None
+
+# Run reports and profile dumps; a subdirectory, so the run cache never treats them as outputs
+PROFILE_DIR = OUTPUT_DIR / "profile"
+REPORT_FILE = PROFILE_DIR / "run_report.json"
+PROFILERS = ('cprofile', 'pyinstrument')
+
+class Span(NamedTuple):
+    """Cost of one phase of a run; memory figures are in MiB, rows is -1 when the phase has no natural size."""
+    phase: str
+    wall_s: float
+    cpu_s: float
+    peak_traced_mb: float
+    max_rss_mb: float
+    rows: int
+
+def cpu_seconds() -> float:
+    """CPU time of this process and of its reaped worker processes."""
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+def max_rss_mb(usage=None) -> float:
+    """High-water resident set size of this process, or of the process usage was reported for
+    (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    max_rss = (usage or resource.getrusage(resource.RUSAGE_SELF)).ru_maxrss
+    return max_rss / (1024 * 1024 if platform.system() == 'Darwin' else 1024)
+
+@contextmanager
+def timed(phase: str):
+    """Measure the enclosed block without a Profiler (e.g. in a worker process); the yielded list receives the Span."""
+    spans = []
+    wall, cpu = time.perf_counter(), cpu_seconds()
+    yield spans
+    spans.append(Span(phase, time.perf_counter() - wall, cpu_seconds() - cpu, float('nan'), max_rss_mb(), -1))
+
+class Profiler:
+    """Records a Span per phase of a run, optionally profiling one phase in detail.
+
+    Spans may nest: each span's traced peak covers everything allocated while it was open, including
+    its children. tracemalloc slows allocation-heavy code noticeably, so it is off unless trace_memory;
+    max RSS is always recorded and is the process high-water mark at the end of the span. Labels given
+    to the constructor (or later assigned to .labels) and to span() become extra report columns.
+    """
+
+    def __init__(self, trace_memory: bool = False, profile_phase: str = None, profiler: str = 'cprofile',
+                 profile_dir: Path = PROFILE_DIR, **labels):
+        if profiler not in PROFILERS:
+            raise ValueError(f"Unknown profiler {profiler!r}; expected one of {PROFILERS}")
+        if profile_phase and profiler == 'pyinstrument' and pyinstrument is None:
+            raise ImportError("pyinstrument is not installed; use the cprofile profiler or pip install pyinstrument")
+        self.trace_memory = trace_memory
+        self.profile_phase = profile_phase
+        self.profiler = profiler
+        self.profile_dir = Path(profile_dir)
+        self.labels = labels
+        self.records = []
+        self._open_peaks = []
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def span(self, phase: str, **labels):
+        """Measure the enclosed block as phase; set the yielded dict's 'rows' to record the size of its result."""
+        result = {'rows': -1}
+        if self.trace_memory:
+            # Fold the peak so far into the enclosing span before restarting the count for this one
+            if self._open_peaks:
+                self._open_peaks[-1] = max(self._open_peaks[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            self._open_peaks.append(0)
+        detail = self._start_profile() if phase == self.profile_phase else None
+        wall, cpu = time.perf_counter(), cpu_seconds()
+        try:
+            yield result
+        finally:
+            wall, cpu = time.perf_counter() - wall, cpu_seconds() - cpu
+            if detail is not None:
+                self._dump_profile(detail, phase)
+            peak = float('nan')
+            if self.trace_memory:
+                peak = max(self._open_peaks.pop(), tracemalloc.get_traced_memory()[1])
+                if self._open_peaks:
+                    self._open_peaks[-1] = max(self._open_peaks[-1], peak)
+                peak /= 1024 * 1024
+            self.record(Span(phase, wall, cpu, peak, max_rss_mb(), result['rows']), **labels)
+
+    @contextmanager
+    def labelled(self, **labels):
+        """Add labels to every span recorded inside the block."""
+        outer = self.labels
+        self.labels = {**outer, **labels}
+        try:
+            yield self
+        finally:
+            self.labels = outer
+
+    def record(self, span: Span, **labels):
+        """Add a span measured elsewhere, e.g. by timed() in a rendering worker."""
+        labels = {**self.labels, **labels}
+        self.records.append((labels, span))
+        context = ' '.join(f"{value}" for value in labels.values())
+        logging.info(f"[profile] {context + ' ' if context else ''}{span.phase}: {span.wall_s:.3f}s wall, "
+                     f"{span.cpu_s:.3f}s cpu, {span.peak_traced_mb:.1f} MiB traced peak, "
+                     f"{span.max_rss_mb:.1f} MiB max RSS, {span.rows} rows")
+
+    def _start_profile(self):
+        if self.profiler == 'pyinstrument':
+            detail = pyinstrument.Profiler()
+            detail.start()
+        else:
+            detail = cProfile.Profile()
+            detail.enable()
+        return detail
+
+    def _dump_profile(self, detail, phase: str):
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        stem = self.profile_dir / re.sub(r'[^\w.-]+', '_', phase)
+        if self.profiler == 'pyinstrument':
+            detail.stop()
+            path = stem.with_suffix('.html')
+            path.write_text(detail.output_html(), encoding='utf-8')
+        else:
+            detail.disable()
+            path = stem.with_suffix('.prof')
+            detail.dump_stats(path)
+            # A readable summary next to the dump, for a quick look without pstats or snakeviz
+            summary = io.StringIO()
+            pstats.Stats(detail, stream=summary).sort_stats('cumulative').print_stats(40)
+            stem.with_suffix('.txt').write_text(summary.getvalue(), encoding='utf-8')
+        logging.info(f"Wrote {self.profiler} profile of {phase} to {path}")
+
+    def save(self, file_path=REPORT_FILE, metadata: dict = None):
+        """Write every span as JSON (with run metadata) and as a CSV next to it."""
+        file_path = Path(file_path)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        label_names = list(dict.fromkeys(name for labels, _ in self.records for name in labels))
+        records = [{**{name: labels.get(name) for name in label_names}, **span._asdict()}
+                   for labels, span in self.records]
+        # NaN (a peak that was not traced) is not valid JSON
+        spans = [{key: None if isinstance(value, float) and math.isnan(value) else value for key, value in record.items()}
+                 for record in records]
+        with open(file_path, 'w', encoding='utf-8') as f:
+            json.dump({'metadata': metadata or {}, 'spans': spans}, f, indent=2, default=str)
+        with open(file_path.with_suffix('.csv'), 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=label_names + list(Span._fields))
+            writer.writeheader()
+            writer.writerows(records)
+        logging.info(f"Saved {len(records)} spans to {file_path}")
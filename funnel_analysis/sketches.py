@@ -0,0 +1,138 @@
+import math
+import numpy as np
+import pandas as pd
+from .processor import is_dask
+
+# HyperLogLog register counts are kept within what a sparse per-group sketch can hold comfortably
+HLL_MIN_PRECISION = 7
+HLL_MAX_PRECISION = 18
+_HLL_PREFIX = 'hll_p'
+_TDIGEST_NAME = 'tdigest'
+
+def hll_precision(error: float) -> int:
+    """Register-index bits giving a relative standard error of at most error (1.04 / sqrt(2**p))."""
+    precision = math.ceil(math.log2((1.04 / error) ** 2))
+    return min(max(precision, HLL_MIN_PRECISION), HLL_MAX_PRECISION)
+
+def hll_error(precision: int) -> float:
+    """Relative standard error of a HyperLogLog estimate at this precision."""
+    return 1.04 / math.sqrt(1 << precision)
+
+def _bit_length(values: np.ndarray) -> np.ndarray:
+    """Exact bit length of each uint64 (0 for 0), by binary search over the shift."""
+    lengths = np.zeros(values.shape, dtype=np.int64)
+    for shift in (32, 16, 8, 4, 2, 1):
+        high = (values >> np.uint64(shift)) > 0
+        values = np.where(high, values >> np.uint64(shift), values)
+        lengths += high * shift
+    return lengths + (values > 0)
+
+def hash_session_ids(ids: pd.Series) -> pd.Series:
+    """64-bit hash of each original session id string, identical across runs, days and storage dtypes."""
+    return pd.Series(pd.util.hash_array(ids.to_numpy(dtype=object)), index=ids.index, name='session_hash')
+
+def _registers(frame: pd.DataFrame, precision: int) -> pd.DataFrame:
+    """Replace session_hash by its HyperLogLog register and rank (position of the first set bit after the index bits)."""
+    hashes = frame['session_hash'].to_numpy()
+    tail_bits = 64 - precision
+    tails = hashes & np.uint64((1 << tail_bits) - 1)
+    return frame.drop(columns='session_hash').assign(
+        register=(hashes >> np.uint64(tail_bits)).astype(np.int32),
+        rank=(tail_bits - _bit_length(tails) + 1).astype(np.uint8)
+    )
+
+def hll_sketch(df: pd.DataFrame, keys: list, precision: int) -> pd.Series:
+    """HyperLogLog sketch of the distinct sessions (by session_hash) per keys group, for pandas and Dask frames alike.
+
+    The sketch is sparse: the maximum rank per (keys..., register), only for registers that were hit.
+    Sketches of any split of the rows merge exactly by taking the maximum per index entry, so Dask
+    reduces them per partition without shuffling session ids. The precision is kept in the name.
+    """
+    columns = df[keys + ['session_hash']]
+    if is_dask(columns):
+        registers = columns.map_partitions(_registers, precision, meta=_registers(columns._meta, precision))
+    else:
+        registers = _registers(columns, precision)
+    return registers.groupby(keys + ['register'], observed=True)['rank'].max().rename(f"{_HLL_PREFIX}{precision}")
+
+def is_hll(result) -> bool:
+    """Whether an aggregate is a HyperLogLog sketch rather than a final value."""
+    return isinstance(result, pd.Series) and str(result.name).startswith(_HLL_PREFIX)
+
+def hll_estimate(sketch: pd.Series) -> pd.Series:
+    """Distinct-count estimate per group of a sketch, named session_id like an exact nunique."""
+    precision = int(sketch.name[len(_HLL_PREFIX):])
+    registers = 1 << precision
+    keys = list(range(sketch.index.nlevels - 1))
+    hit = sketch.groupby(level=keys, observed=True).count()
+    # Registers that were never hit have rank 0 and contribute 2**0 each
+    harmonic = (2.0 ** -sketch.astype(np.float64)).groupby(level=keys, observed=True).sum() + (registers - hit)
+    alpha = 0.7213 / (1 + 1.079 / registers)
+    raw = alpha * registers ** 2 / harmonic
+    # Linear counting is more accurate while many registers are still empty
+    empty = registers - hit
+    linear = registers * np.log(registers / empty.where(empty > 0))
+    estimate = raw.where((raw > 2.5 * registers) | (empty == 0), linear)
+    return estimate.round().astype(np.int64).rename('session_id')
+
+def _k1(q: np.ndarray, compression: float) -> np.ndarray:
+    """t-digest k1 scale: steep near both tails, so centroids there hold few points."""
+    return compression / (2 * np.pi) * np.arcsin(2 * q - 1)
+
+def tdigest_compress(distribution: pd.Series, compression: float) -> pd.Series:
+    """t-digest of each group of a (keys..., value) -> weight distribution, as (keys..., centroid) -> weight.
+
+    Adjacent values are merged into weighted-mean centroids spanning at most one unit of the k1 scale,
+    so a group keeps O(compression) centroids. Each group's minimum and maximum stay single centroids,
+    so the range is exact. A digest is itself such a distribution: digests and raw value counts of any
+    split of the rows merge by summing their weights per index entry and compressing again.
+    """
+    keys = list(distribution.index.names[:-1])
+    frame = distribution.rename('weight').rename_axis(keys + ['centroid']).reset_index()
+    frame = frame.sort_values(keys + ['centroid'], kind='stable')
+    weight = frame['weight'].to_numpy(dtype=np.float64)
+    grouped = frame.groupby(keys, observed=True, sort=False)['weight']
+    total = grouped.transform('sum').to_numpy(dtype=np.float64)
+    right = grouped.cumsum().to_numpy(dtype=np.float64)
+    bucket = np.floor(_k1((right - weight / 2) / total, compression))
+    # Sentinel buckets outside the k1 range keep the extremes apart
+    bucket[right == weight] = -compression
+    bucket[right == total] = compression
+    frame = frame.assign(bucket=bucket, moment=frame['centroid'] * weight)
+    merged = frame.groupby(keys + ['bucket'], observed=True, sort=False)[['weight', 'moment']].sum()
+    levels = [merged.index.get_level_values(key) for key in keys] + [merged['moment'] / merged['weight']]
+    return pd.Series(merged['weight'].to_numpy(), index=pd.MultiIndex.from_arrays(levels, names=keys + ['centroid']),
+                     name=_TDIGEST_NAME)
+
+def tdigest_merge(digests: pd.Series, compression: float) -> pd.Series:
+    """Merge concatenated digests of the same groups into one digest per group."""
+    return tdigest_compress(digests.groupby(level=list(range(digests.index.nlevels)), observed=True).sum(), compression)
+
+def _digest_frame(frame: pd.DataFrame, keys: list, column: str, compression: float) -> pd.DataFrame:
+    return tdigest_compress(frame.groupby(keys + [column], observed=True).size(), compression).reset_index()
+
+def _merge_digest_frames(frames: pd.DataFrame, keys: list, compression: float) -> pd.DataFrame:
+    return tdigest_merge(frames.set_index(keys + ['centroid'])[_TDIGEST_NAME], compression).reset_index()
+
+def _digest_series(frame: pd.DataFrame, keys: list) -> pd.Series:
+    return frame.set_index(keys + ['centroid'])[_TDIGEST_NAME]
+
+def tdigest_sketch(df: pd.DataFrame, keys: list, column: str, compression: float) -> pd.Series:
+    """t-digest of column per keys group, for pandas and Dask frames alike.
+
+    On Dask each partition is digested on its own and the digests are merged in a tree reduction,
+    so only O(compression) centroids per group and partition ever leave a worker.
+    """
+    columns = df[keys + [column]]
+    if is_dask(columns):
+        meta = _digest_frame(columns._meta, keys, column, compression)
+        digests = columns.reduction(_digest_frame, aggregate=_merge_digest_frames, combine=_merge_digest_frames,
+                                    chunk_kwargs={'keys': keys, 'column': column, 'compression': compression},
+                                    combine_kwargs={'keys': keys, 'compression': compression},
+                                    aggregate_kwargs={'keys': keys, 'compression': compression}, meta=meta)
+        return digests.map_partitions(_digest_series, keys, meta=_digest_series(meta, keys))
+    return _digest_series(_digest_frame(columns, keys, column, compression), keys)
+
+def is_tdigest(result) -> bool:
+    """Whether an aggregate is a t-digest."""
+    return isinstance(result, pd.Series) and result.name == _TDIGEST_NAME
@@ -0,0 +1,61 @@
+import os
+import shutil
+import logging
+from pathlib import Path
+import pandas as pd
+from .aggregates import STATE_METRICS
+
+# Layout version of a saved day; bump it whenever STATE_METRICS gains, drops or reshapes a table
+STATE_VERSION = 2
+_VERSION_FILE = "state_version"
+
+def _day_dir(state_dir: Path, day: str) -> Path:
+    return state_dir / f"day={day}"
+
+def save_day_state(state: dict, state_dir: str, day: str):
+    """Write one day's STATE_METRICS results to state_dir/day=<day>/ as Parquet, replacing any earlier state of that day.
+
+    The tables are staged in a hidden directory and swapped in whole, so a failed run never leaves a partial day.
+    """
+    state_dir = Path(state_dir)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    staging = state_dir / f".day={day}.tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir()
+    for name, result in state.items():
+        frame = result if isinstance(result, pd.DataFrame) else result.to_frame(result.name or 'count')
+        frame.to_parquet(staging / f"{name}.parquet")
+    (staging / _VERSION_FILE).write_text(f"{STATE_VERSION}\n")
+
+    target = _day_dir(state_dir, day)
+    if target.exists():
+        shutil.rmtree(target)
+    os.replace(staging, target)
+    logging.info(f"Saved aggregate state for {day} to {target}")
+
+def _check_day_dir(day_dir: Path, day: str):
+    """Fail with the day to rebuild if its state was saved by another state version or lacks a table."""
+    version_file = day_dir / _VERSION_FILE
+    version = version_file.read_text().strip() if version_file.exists() else "none"
+    missing = [f"{name}.parquet" for name in STATE_METRICS if not (day_dir / f"{name}.parquet").exists()]
+    if version != str(STATE_VERSION):
+        problem = f"was saved with state version {version}, this code reads version {STATE_VERSION}"
+    elif missing:
+        problem = f"is missing {', '.join(missing)}"
+    else:
+        return
+    raise ValueError(f"Aggregate state of day {day} in {day_dir} {problem}; rebuild it by rerunning "
+                     f"--delta <that day's sessions file> --day {day}")
+
+def load_day_states(state_dir: str) -> dict:
+    """Read the state of every day in state_dir, keyed by day."""
+    states = {}
+    for day_dir in sorted(Path(state_dir).glob('day=*')):
+        day = day_dir.name.split('=', 1)[1]
+        _check_day_dir(day_dir, day)
+        state = {}
+        for name in STATE_METRICS:
+            frame = pd.read_parquet(day_dir / f"{name}.parquet")
+            state[name] = frame if len(frame.columns) > 1 else frame[frame.columns[0]]
+        states[day] = state
+    return states
@@ -0,0 +1,266 @@
+import argparse
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Iterator, NamedTuple
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from .data_loader import STORE_SCHEMAS
+
+try:
+    import orjson
+except ImportError:  # Optional: NDJSON is then written with the stdlib encoder
+    orjson = None
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Funnel vocabulary of the generated data, in the shape categorize-event-names.py writes funnel_events.json
+STAGE_EVENTS = {
+    'Browsing': ['view_plp', 'view_pdp', 'search'],
+    'Adding to Cart': ['add_to_cart'],
+    'Checkout': ['begin_checkout', 'checkout_step'],
+    'Purchase': ['purchase']
+}
+STAGE_URLS = [['/w', '/w/men', '/w/women', '/t/dunk', '/search'], ['/cart'], ['/checkout'], ['/checkout/confirmation']]
+ERROR_EVENTS = ['Page Error', 'payment_error']
+# Names of the most common non-funnel events; larger vocabularies add custom_event_<n> names
+COMMON_EVENTS = ['view_home', 'scroll', 'login', 'view_wishlist', 'share', 'filter_apply', 'sort_apply', 'logout']
+NAVIGATION_URLS = ['/', '/launch', '/home', '/w/men', '/w/women', '/t/dunk', '/member/profile', '/favorites']
+SEARCH_KEYWORDS = ['shoes', 'air max', 'dunk low', 'running', 'jordan']
+GENDERS = np.array(['MEN', 'WOMEN', None], dtype=object)
+COUNTRIES = np.array(['TH', 'VN', 'SG', 'MY', 'PH', 'ID'], dtype=object)
+AGES = np.array([np.nan, 17, 22, 30, 41, 55, 70])
+
+# Columns of the raw clickstream export (data.csv)
+CLICKSTREAM_COLUMNS = ['upm_id', 'session_id', 'age', 'available_gender', 'country', 'timestamp', 'event_name',
+                       'search_keyword', 'filters', 'page_url', 'product_name', 'total', 'product_inventory_status']
+
+class SyntheticSpec(NamedTuple):
+    """Shape of a synthetic clickstream.
+
+    events: total events to generate (whole sessions, so the last one may overshoot slightly).
+    vocabulary: distinct event names, funnel and error events included; the rest follow a Zipf popularity.
+    conversion: share of sessions reaching the first stage, then the conversion rate of each next stage.
+    """
+    events: int
+    vocabulary: int = 40
+    conversion: tuple = (0.7, 0.45, 0.55, 0.65)
+    mean_events: float = 12.0
+    error_rate: float = 0.03
+    mean_gap_seconds: float = 45.0
+    days: int = 30
+    start: str = '2025-03-01'
+    sessions_per_user: float = 2.0
+    seed: int = 0
+
+class SyntheticChunk(NamedTuple):
+    """One chunk of generated sessions in the columnar session store layout (timestamps in epoch microseconds)."""
+    sessions: pd.DataFrame
+    events: pd.DataFrame
+
+def _event_names(vocabulary: int) -> tuple[list, int]:
+    """The full event vocabulary, funnel events first, and the index where non-funnel events start."""
+    funnel = [name for names in STAGE_EVENTS.values() for name in names] + ERROR_EVENTS
+    extra = max(vocabulary - len(funnel), 1)
+    common = COMMON_EVENTS[:extra] + [f'custom_event_{n}' for n in range(extra - len(COMMON_EVENTS))]
+    return funnel + common, len(funnel)
+
+def _chunk(rng: np.random.Generator, spec: SyntheticSpec, first_session: int, session_count: int,
+           total_users: int) -> SyntheticChunk:
+    """Generate session_count sessions, vectorized over sessions and events."""
+    names, common_start = _event_names(spec.vocabulary)
+    common_count = len(names) - common_start
+    popularity = 1 / np.arange(1, common_count + 1)
+    stage_count = len(STAGE_EVENTS)
+
+    # Stages reached: each stage needs every earlier one, so the funnel is a running product of conversions
+    reached = np.cumprod(rng.random((session_count, stage_count)) < np.asarray(spec.conversion), axis=1)
+    depth = reached.sum(axis=1)
+    lengths = np.maximum(1 + rng.poisson(max(spec.mean_events - 1, 0), session_count), depth)
+    total = int(lengths.sum())
+    offsets = np.cumsum(lengths) - lengths
+    session = np.repeat(np.arange(session_count), lengths)
+
+    codes = common_start + rng.choice(common_count, size=total, p=popularity / popularity.sum())
+    url_names = list(dict.fromkeys(NAVIGATION_URLS + [url for stage_urls in STAGE_URLS for url in stage_urls]))
+    urls = rng.choice(len(NAVIGATION_URLS), size=total)
+    errors = rng.random(total) < spec.error_rate
+    codes[errors] = common_start - len(ERROR_EVENTS) + rng.integers(0, len(ERROR_EVENTS), errors.sum())
+
+    # The k-th stage a session reaches is placed at position k * length // depth, so stages stay in order
+    anchor_session = np.repeat(np.arange(session_count), depth)
+    anchor_stage = np.arange(len(anchor_session)) - np.repeat(np.cumsum(depth) - depth, depth)
+    anchor_pos = offsets[anchor_session] + anchor_stage * lengths[anchor_session] // depth[anchor_session]
+    stage_first = np.cumsum([0] + [len(events) for events in STAGE_EVENTS.values()])
+    stage_sizes = np.diff(stage_first)
+    codes[anchor_pos] = stage_first[anchor_stage] + (rng.random(len(anchor_pos)) * stage_sizes[anchor_stage]).astype(np.int64)
+    stage_url_codes = np.array([url_names.index(url) for stage_urls in STAGE_URLS for url in stage_urls])
+    url_offsets = np.cumsum([0] + [len(stage_urls) for stage_urls in STAGE_URLS])
+    url_sizes = np.diff(url_offsets)
+    urls[anchor_pos] = stage_url_codes[url_offsets[anchor_stage] + (rng.random(len(anchor_pos)) * url_sizes[anchor_stage]).astype(np.int64)]
+
+    start_us = pd.Timestamp(spec.start).value // 1000
+    session_start = start_us + rng.integers(0, spec.days * 86_400, session_count) * 1_000_000
+    elapsed = np.cumsum(np.ceil(rng.exponential(spec.mean_gap_seconds, total))).astype(np.int64)
+    elapsed -= elapsed[offsets][session]  # Every session starts with its first event
+    timestamps = session_start[session] + elapsed * 1_000_000
+
+    session_idx = first_session + np.arange(session_count)
+    event_names = pd.Categorical.from_codes(codes, categories=names)
+    is_search = event_names == 'search'
+    sessions = pd.DataFrame({
+        'session_idx': session_idx,
+        'session_id': np.char.add('s', session_idx.astype(str)).astype(object),
+        'upm_id': np.char.add('u', rng.integers(0, total_users, session_count).astype(str)).astype(object),
+        'age': rng.choice(AGES, session_count),
+        'gender': rng.choice(GENDERS, session_count),
+        'country': rng.choice(COUNTRIES, session_count),
+        'start_session': session_start,
+        'end_session': timestamps[offsets + lengths - 1]
+    })
+    events = pd.DataFrame({
+        'session_idx': session_idx[session],
+        'event_name': event_names,
+        'search_keyword': np.where(is_search, np.array(SEARCH_KEYWORDS, dtype=object)[rng.integers(0, len(SEARCH_KEYWORDS), total)], ''),
+        'filters': '[]',
+        'page_url': pd.Categorical.from_codes(urls, categories=url_names),
+        'product_name': '',
+        'total': '',
+        'product_inventory_status': '',
+        'timestamp': timestamps
+    })
+    return SyntheticChunk(sessions, events)
+
+def generate_chunks(spec: SyntheticSpec, chunk_sessions: int = 100_000) -> Iterator[SyntheticChunk]:
+    """Yield the sessions of spec chunk by chunk, so any size is generated in bounded memory."""
+    rng = np.random.default_rng(spec.seed)
+    total_sessions = max(int(np.ceil(spec.events / spec.mean_events)), 1)
+    total_users = max(int(total_sessions / spec.sessions_per_user), 1)
+    generated = 0
+    first_session = 0
+    while generated < spec.events:
+        # Size the chunk from the events still needed, so the total lands close to spec.events
+        count = min(chunk_sessions, max(int(np.ceil((spec.events - generated) / spec.mean_events)), 1))
+        chunk = _chunk(rng, spec, first_session, count, total_users)
+        generated += len(chunk.events)
+        first_session += count
+        yield chunk
+
+def _clickstream_rows(chunk: SyntheticChunk) -> pd.DataFrame:
+    """Chunk as raw export rows: one row per event with its session's fields, in time order."""
+    rows = chunk.events.merge(chunk.sessions, on='session_idx', how='left')
+    rows = rows.sort_values('timestamp', kind='stable')
+    return pd.DataFrame({
+        'upm_id': rows['upm_id'],
+        'session_id': rows['session_id'],
+        'age': rows['age'],
+        'available_gender': rows['gender'],
+        'country': rows['country'],
+        'timestamp': pd.to_datetime(rows['timestamp'], unit='us').dt.strftime('%Y-%m-%d %H:%M:%S'),
+        'event_name': rows['event_name'],
+        'search_keyword': rows['search_keyword'],
+        'filters': rows['filters'],
+        'page_url': rows['page_url'],
+        'product_name': rows['product_name'],
+        'total': rows['total'],
+        'product_inventory_status': rows['product_inventory_status']
+    }, columns=CLICKSTREAM_COLUMNS)
+
+def write_clickstream_csv(spec: SyntheticSpec, file_path: str = 'data.csv') -> int:
+    """Write a raw clickstream export like data.csv and return its row count.
+
+    Rows are time-ordered within each chunk of sessions, so sessions interleave as in a real export.
+    """
+    rows = 0
+    with open(file_path, 'w', newline='', encoding='utf-8') as f:
+        for chunk in generate_chunks(spec):
+            _clickstream_rows(chunk).to_csv(f, index=False, header=rows == 0)
+            rows += len(chunk.events)
+    logging.info(f"Wrote {rows} clickstream rows to {file_path}")
+    return rows
+
+def _session_dicts(chunk: SyntheticChunk) -> Iterator[dict]:
+    """Sessions of a chunk as the dicts load_and_clean_data.py writes."""
+    events = chunk.events
+    timestamps = np.datetime_as_string(events['timestamp'].to_numpy().astype('datetime64[us]').astype('datetime64[s]')).tolist()
+    starts = np.datetime_as_string(chunk.sessions['start_session'].to_numpy().astype('datetime64[us]').astype('datetime64[s]')).tolist()
+    ends = np.datetime_as_string(chunk.sessions['end_session'].to_numpy().astype('datetime64[us]').astype('datetime64[s]')).tolist()
+    columns = zip(events['event_name'].tolist(), events['search_keyword'].tolist(), events['page_url'].tolist(), timestamps)
+    event_dicts = [{'event_name': name, 'search_keyword': keyword, 'filters': [], 'page_url': url, 'product_name': '',
+                    'total': '', 'product_inventory_status': '', 'timestamp': timestamp}
+                   for name, keyword, url, timestamp in columns]
+    bounds = np.append(np.flatnonzero(np.diff(events['session_idx'].to_numpy(), prepend=-1)), len(events))
+    sessions = chunk.sessions
+    for i, (session_id, upm_id, age, gender, country) in enumerate(zip(
+            sessions['session_id'].tolist(), sessions['upm_id'].tolist(), sessions['age'].tolist(),
+            sessions['gender'].tolist(), sessions['country'].tolist())):
+        yield {
+            'session_id': session_id,
+            'upm_id': upm_id,
+            'age': None if np.isnan(age) else int(age),
+            'gender': gender,
+            'country': country,
+            'start_session': starts[i],
+            'end_session': ends[i],
+            'events': event_dicts[bounds[i]:bounds[i + 1]]
+        }
+
+def write_sessions_ndjson(spec: SyntheticSpec, file_path: str = 'sessions.ndjson') -> int:
+    """Write sessions as NDJSON (one session per line, like --format ndjson) and return the session count."""
+    count = 0
+    with open(file_path, 'wb') as f:
+        for chunk in generate_chunks(spec):
+            for session in _session_dicts(chunk):
+                f.write(orjson.dumps(session) if orjson is not None else json.dumps(session, ensure_ascii=False).encode('utf-8'))
+                f.write(b'\n')
+                count += 1
+    logging.info(f"Wrote {count} sessions to {file_path}")
+    return count
+
+def write_session_store(spec: SyntheticSpec, dir_path: str = 'sessions_store') -> int:
+    """Write a Parquet session store (sessions.parquet, events.parquet; one row group per chunk) and return the session count."""
+    os.makedirs(dir_path, exist_ok=True)
+    count = 0
+    with pq.ParquetWriter(os.path.join(dir_path, 'sessions.parquet'), STORE_SCHEMAS['sessions']) as sessions_writer, \
+            pq.ParquetWriter(os.path.join(dir_path, 'events.parquet'), STORE_SCHEMAS['events']) as events_writer:
+        for chunk in generate_chunks(spec):
+            sessions_writer.write_table(pa.Table.from_pandas(chunk.sessions, schema=STORE_SCHEMAS['sessions'], preserve_index=False))
+            events = chunk.events.astype({'event_name': str, 'page_url': str})
+            events_writer.write_table(pa.Table.from_pandas(events, schema=STORE_SCHEMAS['events'], preserve_index=False))
+            count += len(chunk.sessions)
+    logging.info(f"Wrote {count} sessions to {dir_path}")
+    return count
+
+def write_funnel_events(file_path: str = 'funnel_events.json'):
+    """Write the stage -> event names mapping of the synthetic vocabulary."""
+    with open(file_path, 'w', encoding='utf-8') as f:
+        json.dump(STAGE_EVENTS, f, indent=2)
+
+WRITERS = {'csv': write_clickstream_csv, 'ndjson': write_sessions_ndjson, 'parquet': write_session_store}
+DEFAULT_PATHS = {'csv': 'data.csv', 'ndjson': 'sessions.ndjson', 'parquet': 'sessions_store'}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic clickstream or session file")
+    parser.add_argument("--events", type=int, required=True, help="Total events to generate (e.g. 10000 to 100000000)")
+    parser.add_argument("--format", choices=sorted(WRITERS), default="csv",
+                        help="Raw data.csv export, sessions NDJSON, or a Parquet session store")
+    parser.add_argument("--output", help="Output path (default: data.csv, sessions.ndjson or sessions_store/)")
+    parser.add_argument("--vocabulary", type=int, default=SyntheticSpec._field_defaults['vocabulary'],
+                        help="Distinct event names")
+    parser.add_argument("--conversion", type=float, nargs=len(STAGE_EVENTS), default=SyntheticSpec._field_defaults['conversion'],
+                        help="Share reaching the first stage, then each next stage's conversion rate")
+    parser.add_argument("--mean-events", type=float, default=SyntheticSpec._field_defaults['mean_events'],
+                        help="Mean events per session")
+    parser.add_argument("--error-rate", type=float, default=SyntheticSpec._field_defaults['error_rate'],
+                        help="Share of events that are error events")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    spec = SyntheticSpec(events=args.events, vocabulary=args.vocabulary, conversion=tuple(args.conversion),
+                         mean_events=args.mean_events, error_rate=args.error_rate, seed=args.seed)
+    output = args.output or DEFAULT_PATHS[args.format]
+    WRITERS[args.format](spec, output)
+    write_funnel_events(str(Path(output).parent / 'funnel_events.json'))
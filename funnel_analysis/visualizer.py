@@ -1,148 +1,121 @@
+import os
+from contextlib import nullcontext
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-import plotly.graph_objects as go
 import logging
-import dask.dataframe as dd
 from .config import OUTPUT_DIR, CONFIG
+from .processor import FunnelData
+from .cache import ArtifactCache
+from .profiling import Profiler, timed
 
-def visualize_funnel(stage_counts: pd.Series, conversion_rates: pd.Series, drop_off_rates: pd.Series, stages: list):
-    """Generate clear, business-friendly funnel visualizations."""
-    logging.info("Generating funnel visualizations")
-    
-    fig = go.Figure(go.Funnel(
-        y=stages, x=stage_counts, textposition="inside", 
-        textinfo="value+percent previous", marker={"color": "teal"}
-    ))
-    fig.update_layout(title="User Journey Through Funnel", title_x=0.5)
-    fig.write_image(OUTPUT_DIR / "funnel_chart.png")
-    
-    plt.figure(figsize=(12, 6))
-    sns.barplot(x=stages, y=stage_counts, palette="Blues_d", order=stages)
-    plt.title('How Many Users Reach Each Stage?')
-    plt.xlabel('Stage')
-    plt.ylabel('Number of Users')
-    for i, v in enumerate(stage_counts):
-        plt.text(i, v + max(stage_counts) * 0.01, str(int(v)), ha='center', va='bottom')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.savefig(OUTPUT_DIR / "sessions_per_stage.png")
-    plt.close()
-    
-    plt.figure(figsize=(12, 6))
-    sns.barplot(x=stages[1:], y=drop_off_rates[1:] * 100, palette="Reds_d", order=stages[1:])
-    plt.title('Where Are We Losing Users? (%)')
-    plt.xlabel('Stage Transition')
-    plt.ylabel('Drop-Off Rate (%)')
-    for i, v in enumerate(drop_off_rates[1:] * 100):
-        plt.text(i, v + 1, f"{v:.1f}%", ha='center', va='bottom')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.savefig(OUTPUT_DIR / "drop_off_rates.png")
-    plt.close()
+class ChartJob(NamedTuple):
+    """One independent chart: charts.<render>(path, **data) writes a PNG from small, picklable inputs.
 
-    # Cumulative Drop-Off Line Plot
-    cumulative_drop = (1 - conversion_rates) * 100
-    plt.figure(figsize=(12, 6))
-    sns.lineplot(x=stages, y=cumulative_drop, marker='o', color='purple')
-    plt.title('Cumulative Drop-Off Across Stages (%)')
-    plt.xlabel('Stage')
-    plt.ylabel('Cumulative Drop-Off Rate (%)')
-    for i, v in enumerate(cumulative_drop):
-        plt.text(i, v + 1, f"{v:.1f}%", ha='center', va='bottom')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.savefig(OUTPUT_DIR / "cumulative_drop_off.png")
-    plt.close()
+    render is a function name rather than the function, so building jobs (and restoring them from
+    the cache) never imports the plotting stack.
+    """
+    filename: str
+    render: str
+    data: dict
 
-def visualize_root_causes(time_spent: pd.Series, error_df: pd.DataFrame, top_events_df: pd.DataFrame, df: pd.DataFrame, stages: list):
-    """Visualize root cause analysis with additional charts."""
-    logging.info("Generating root cause visualizations")
-    
-    plt.figure(figsize=(10, 6))
-    sns.barplot(x=stages, y=time_spent.reindex(stages), palette="Greens_d", order=stages)
-    plt.title('Average Time Spent Before Reaching Each Stage (s)')
-    plt.xlabel('Stage')
-    plt.ylabel('Time (seconds)')
-    for i, v in enumerate(time_spent.reindex(stages)):
-        plt.text(i, v + 1, f"{v:.1f}", ha='center', va='bottom')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.savefig(OUTPUT_DIR / "time_spent_per_stage.png")
-    plt.close()
+def _init_render_worker():
+    """Use the non-interactive backend in every rendering process."""
+    import matplotlib
+    matplotlib.use('Agg')
+
+def _stage_pivot(counts: pd.Series, columns: list, stages: list) -> pd.DataFrame:
+    """Turn (stage, segment) session counts into a stage x segment table of row percentages."""
+    pivot = counts.unstack(fill_value=0).reindex(index=stages, columns=columns, fill_value=0)
+    return pivot.div(pivot.sum(axis=1), axis=0) * 100  # Normalize to percentages
 
+def funnel_chart_jobs(stage_counts: pd.Series, conversion_rates: pd.Series, drop_off_rates: pd.Series, stages: list) -> list:
+    """Chart jobs for the business-friendly funnel overview."""
+    return [
+        ChartJob("funnel_chart.png", 'render_funnel_chart', {'stages': stages, 'stage_counts': stage_counts}),
+        ChartJob("sessions_per_stage.png", 'render_sessions_per_stage', {'stages': stages, 'stage_counts': stage_counts}),
+        ChartJob("drop_off_rates.png", 'render_drop_off_rates', {'stages': stages, 'drop_off_rates': drop_off_rates}),
+        ChartJob("cumulative_drop_off.png", 'render_cumulative_drop_off', {'stages': stages, 'conversion_rates': conversion_rates})
+    ]
+
+def root_cause_chart_jobs(time_spent: pd.Series, error_df: pd.DataFrame, top_events_df: pd.DataFrame, aggregates: dict, stages: list) -> list:
+    """Chart jobs for root cause analysis, built only from precomputed aggregates."""
+    jobs = [ChartJob("time_spent_per_stage.png", 'render_time_spent', {'stages': stages, 'time_spent': time_spent})]
     if not error_df.empty:
-        plt.figure(figsize=(10, 6))
-        sns.barplot(x='Stage', y='Sessions with Errors', data=error_df, palette="Reds_d", order=stages)
-        plt.title('Error Impact by Stage')
-        plt.xlabel('Stage')
-        plt.ylabel('Users Affected by Errors')
-        for i, v in enumerate(error_df['Sessions with Errors']):
-            plt.text(i, v + 1, str(int(v)), ha='center', va='bottom')
-        plt.xticks(rotation=45)
-        plt.tight_layout()
-        plt.savefig(OUTPUT_DIR / "error_sessions_per_stage.png")
-        plt.close()
+        jobs.append(ChartJob("error_sessions_per_stage.png", 'render_error_sessions', {'stages': stages, 'error_df': error_df}))
+    jobs.append(ChartJob("top_events_per_stage.png", 'render_top_events', {'stages': stages, 'top_events_df': top_events_df}))
 
-    plt.figure(figsize=(14, 8))
-    sns.barplot(x='Stage', y='User Count', hue='Event', data=top_events_df, palette="viridis", order=stages)
-    plt.title('Top 5 Events per Stage')
-    plt.xlabel('Stage')
-    plt.ylabel('Number of Users')
-    plt.legend(title='Event', bbox_to_anchor=(1.05, 1), loc='upper left')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.savefig(OUTPUT_DIR / "top_events_per_stage.png", bbox_inches='tight')
-    plt.close()
+    box_summary = aggregates['time_distribution'].unstack().reindex(stages).dropna()
+    jobs.append(ChartJob("time_to_stage_boxplot.png", 'render_time_to_stage_boxplot', {'stages': stages, 'box_summary': box_summary}))
 
-    if isinstance(df, dd.DataFrame):
-        df = df.compute()
-    plt.figure(figsize=(12, 6))
-    sns.boxplot(x='stage', y='time_to_stage', data=df, palette="Pastel1", order=stages)
-    plt.title('Time to Reach Each Stage (s) - Distribution')
-    plt.xlabel('Stage')
-    plt.ylabel('Time (seconds)')
-    plt.xticks(rotation=45)
-    plt.tight_layout()
-    plt.savefig(OUTPUT_DIR / "time_to_stage_boxplot.png")
-    plt.close()
+    gender_counts = aggregates['gender']
+    pivot_gender = _stage_pivot(gender_counts, sorted(gender_counts.index.get_level_values('gender').unique()), stages)
+    jobs.append(ChartJob("drop_off_gender_heatmap.png", 'render_heatmap',
+                         {'pivot': pivot_gender, 'title': 'Drop-Off Patterns by Gender (%)', 'xlabel': 'Gender'}))
+    pivot_age = _stage_pivot(aggregates['age_groups'], CONFIG['age_labels'], stages)
+    jobs.append(ChartJob("drop_off_age_heatmap.png", 'render_heatmap',
+                         {'pivot': pivot_age, 'title': 'Drop-Off Patterns by Age Group (%)', 'xlabel': 'Age Group'}))
+    return jobs
 
-    if isinstance(df, dd.DataFrame):
-        df = df.compute()
+def _draw(job: ChartJob, path):
+    from . import charts  # Deferred: matplotlib, seaborn and plotly load only once a chart is really drawn
+    getattr(charts, job.render)(path, **job.data)
 
-    df['Age Group'] = pd.cut(df['age'], bins=[0, 18, 35, 50, 100], labels=['0-18', '19-35', '36-50', '51+'])
-    df['stage'] = pd.Categorical(df['stage'], categories=stages, ordered=True)
-    
-    pivot_gender = df.pivot_table(index='stage', columns='gender', values='session_id', aggfunc='nunique', fill_value=0, observed=False)
-    pivot_gender = pivot_gender.div(pivot_gender.sum(axis=1), axis=0) * 100  # Normalize to percentages
-    plt.figure(figsize=(8, 6))
-    sns.heatmap(pivot_gender, annot=True, fmt='.1f', cmap='YlOrRd', cbar_kws={'label': 'Percentage (%)'})
-    plt.title('Drop-Off Patterns by Gender (%)')
-    plt.xlabel('Gender')
-    plt.ylabel('Stage')
-    plt.tight_layout()
-    plt.savefig(OUTPUT_DIR / "drop_off_gender_heatmap.png")
-    plt.close()
+def _run_job(job: ChartJob, path):
+    with timed(f"chart:{job.filename}") as spans:
+        _draw(job, path)
+    return spans[0]
+
+def render_charts(jobs: list, workers: int = CONFIG['render_workers'], cache: ArtifactCache = None,
+                  profiler: Profiler = None, output_dir: Path = OUTPUT_DIR):
+    """Render chart jobs into output_dir, in parallel on a process pool unless workers is 0 or 1.
+
+    workers=None uses one process per core (capped at the number of jobs). With a cache, a chart
+    whose inputs and code are unchanged is restored from it instead of being drawn again. With a
+    profiler, each drawn chart is recorded as a chart:<filename> span; charts drawn in pool workers
+    are timed there, so they have no traced peak and cannot be profiled in detail.
+    """
+    keys = {}
+    if cache is not None:
+        # Cached artifacts are named by their path below the cache's output directory
+        artifacts = {job.filename: (output_dir / job.filename).relative_to(cache.output_dir).as_posix() for job in jobs}
+        keys = {job.filename: cache.key(job.filename, job.render, job.data) for job in jobs}
+        cached = {job.filename for job in jobs if cache.restore(artifacts[job.filename], keys[job.filename])}
+        logging.info(f"Restored {len(cached)} unchanged charts from cache")
+        jobs = [job for job in jobs if job.filename not in cached]
+    if jobs:
+        _render_jobs(jobs, workers, profiler, output_dir)
+    if cache is not None:
+        for job in jobs:
+            cache.store(artifacts[job.filename], keys[job.filename])
 
-    pivot_age = df.pivot_table(index='stage', columns='Age Group', values='session_id', aggfunc='nunique', fill_value=0, observed=False)
-    pivot_age = pivot_age.div(pivot_age.sum(axis=1), axis=0) * 100  # Normalize to percentages
-    plt.figure(figsize=(8, 6))
-    sns.heatmap(pivot_age, annot=True, fmt='.1f', cmap='YlOrRd', cbar_kws={'label': 'Percentage (%)'})
-    plt.title('Drop-Off Patterns by Age Group (%)')
-    plt.xlabel('Age Group')
-    plt.ylabel('Stage')
-    plt.tight_layout()
-    plt.savefig(OUTPUT_DIR / "drop_off_age_heatmap.png")
-    plt.close()
+def _render_jobs(jobs: list, workers: int, profiler: Profiler, output_dir: Path):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(jobs))
+    logging.info(f"Rendering {len(jobs)} charts with {workers or 1} process(es)")
+    if workers <= 1:
+        for job in jobs:
+            with profiler.span(f"chart:{job.filename}") if profiler is not None else nullcontext():
+                _draw(job, output_dir / job.filename)
+        return
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_render_worker) as pool:
+        futures = [pool.submit(_run_job, job, output_dir / job.filename) for job in jobs]
+        for future in futures:
+            span = future.result()
+            if profiler is not None:
+                profiler.record(span)
 
-def generate_insights(df: pd.DataFrame, stage_counts: pd.Series, drop_off_rates: pd.Series, error_df: pd.DataFrame):
+def generate_insights(data: FunnelData, stage_counts: pd.Series, drop_off_rates: pd.Series, error_df: pd.DataFrame,
+                      output_dir: Path = OUTPUT_DIR):
     """Generate a business-friendly text summary."""
     logging.info("Generating insights summary")
     max_drop_stage = drop_off_rates.idxmax()
     max_drop_rate = drop_off_rates.max() * 100
     total_users = stage_counts[0]
     
-    with open(OUTPUT_DIR / "insights.txt", "w") as f:
+    with open(output_dir / "insights.txt", "w") as f:
         f.write("Funnel Drop-Off Insights\n")
         f.write("====================\n")
         f.write(f"Total Users Started: {int(total_users)}\n")